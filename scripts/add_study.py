@@ -6,21 +6,34 @@ import os
 import sys
 import csv
 import json
-from io import BytesIO
-from collections import namedtuple
+import time
+import hashlib
+from xml.etree import ElementTree
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+import urllib3
 import requests
-import sierrapy
 from tqdm import tqdm
-from Bio import Entrez
 
-Entrez.email = 'hivdbteam@stanford.edu'
+from common import (OFFLINE, NCBI_API_KEY, NCBI_RATE, SIERRA_QUERY,
+                    RateLimiter, atomic_write, is_transient_http_error,
+                    iter_sierra_results, retry)
 
 BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 LOCALDIR = os.path.join(BASEDIR, 'local', 'new_studies')
-SIERRAPY_QUERY = os.path.join(BASEDIR, 'scripts', 'query.gql')
 LANL_TAG_START = '##HIVDataBaseData-START##'
 LANL_TAG_END = '##HIVDataBaseData-END##'
+ELINK_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/elink.fcgi'
+EFETCH_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+EFETCH_BATCH = 24
+EFETCH_WORKERS = 3
+EUTILS_RETRIES = 5
+EUTILS_BACKOFF = 2  # seconds, doubled after each failed attempt
+ENTREZ_CACHE_DIR = os.path.join(BASEDIR, 'local', 'entrez')
+ENTREZ_TTL = 7 * 24 * 3600  # seconds before a cached response is refetched
+# an accession.version always names the same record, so never expires
+PATTERN_VERSIONED = re.compile(r'^[A-Z]{1,2}_?\d+\.\d+$')
 
 os.makedirs(LOCALDIR, exist_ok=True)
 
@@ -29,18 +42,113 @@ SequenceTuple = namedtuple(
     'SequenceTuple',
     ['accession', 'header', 'sequence',
      'pmid', 'isolate_name', 'isolate_date',
-     'source', 'patient', 'extra']
+     'source', 'patient', 'extra', 'seqids']
 )
 
 
+def eutils_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=EFETCH_WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class EntrezCache:
+    """Content-addressed store of E-utilities responses
+
+    Each body is saved once as objects/<sha1>; index.json maps elink
+    PMIDs and efetch IDs (accession, accession.version and GI of a
+    GBSeq record) to the object and the time it was fetched. In OFFLINE
+    mode entries never expire, so add_study replays recorded responses.
+    """
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.indexpath = os.path.join(cachedir, 'index.json')
+        self.index = {'elink': {}, 'efetch': {}}
+        if os.path.exists(self.indexpath):
+            with open(self.indexpath) as fp:
+                self.index.update(json.load(fp))
+
+    def get(self, kind, key):
+        entry = self.index[kind].get(key)
+        if entry is None:
+            return None
+        if not OFFLINE and not PATTERN_VERSIONED.match(key) and \
+                time.time() - entry['fetched'] > ENTREZ_TTL:
+            return None
+        path = os.path.join(self.cachedir, 'objects', entry['object'])
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    def put(self, kind, keys, content):
+        sha1 = hashlib.sha1(content).hexdigest()
+        path = os.path.join(self.cachedir, 'objects', sha1)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with atomic_write(path, 'wb') as fp:
+                fp.write(content)
+        fetched = time.time()
+        for key in keys:
+            self.index[kind][key] = {'object': sha1, 'fetched': fetched}
+
+    def save(self):
+        os.makedirs(self.cachedir, exist_ok=True)
+        with atomic_write(self.indexpath) as fp:
+            json.dump(self.index, fp)
+
+
+EUTILS_SESSION = eutils_session()
+EUTILS_LIMITER = RateLimiter(NCBI_RATE)
+ENTREZ_CACHE = EntrezCache(ENTREZ_CACHE_DIR)
+
+
+def eutils_request(method, url, params, stream=False):
+    """Send an E-utilities request under NCBI's rate limit
+
+    Connection errors, 429 and 5xx responses are retried with
+    exponential backoff. With ``stream``, only the headers are read.
+    """
+    params = dict(params)
+    if NCBI_API_KEY:
+        params['api_key'] = NCBI_API_KEY
+
+    def request():
+        EUTILS_LIMITER.wait()
+        resp = EUTILS_SESSION.request(
+            method, url, timeout=120, stream=stream,
+            **{'params' if method == 'GET' else 'data': params})
+        resp.raise_for_status()
+        return resp
+
+    return retry(request, EUTILS_RETRIES, EUTILS_BACKOFF,
+                 requests.RequestException, what=url.rsplit('/', 1)[-1],
+                 retryable=is_transient_http_error)
+
+
 def get_accs(pmid):
-    resp = requests.get(
-        'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/elink.fcgi',
-        {'dbfrom': 'pubmed',
-         'db': 'nuccore',
-         'id': pmid,
-         'retmode': 'json'})
-    data = json.load(BytesIO(resp.content))
+    content = ENTREZ_CACHE.get('elink', pmid)
+    if content is None:
+        if OFFLINE:
+            raise RuntimeError(
+                'No cached elink response of PMID {} in offline mode'
+                .format(pmid))
+        content = eutils_request(
+            'GET', ELINK_URL,
+            {'dbfrom': 'pubmed',
+             'db': 'nuccore',
+             'id': pmid,
+             'retmode': 'json'}).content
+        data = json.loads(content)
+        if 'error' not in data:
+            ENTREZ_CACHE.put('elink', [pmid], content)
+            ENTREZ_CACHE.save()
+    else:
+        data = json.loads(content)
     if 'error' in data:
         return []
     linkset = data['linksets'][0]
@@ -70,58 +178,168 @@ def parse_lanl_data(comment):
     return r
 
 
-def get_sequences(pmid, accs, step=24):
+def fetch_gbseq(accs):
+    """Send an efetch request, leaving the GBSeq XML body unread"""
+    # Entrez.efetch is too slow because it doesn't support gzip
+    resp = eutils_request(
+        'POST', EFETCH_URL,
+        {'db': 'nuccore',
+         'id': ','.join(str(a) for a in accs),
+         'retmode': 'xml'},
+        stream=True)
+    resp.raw.decode_content = True
+    return resp
+
+
+def iter_gbseq(fp):
+    """Yield each <GBSeq> element of a GBSeq XML stream
+
+    An element is cleared once the caller resumes, so only one record
+    is held in memory whatever the size of the stream.
+    """
+    root = None
+    for event, elem in ElementTree.iterparse(fp, ('start', 'end')):
+        if root is None:
+            root = elem
+        elif event == 'end' and elem.tag == 'GBSeq':
+            yield elem
+            root.clear()
+
+
+def gbseq_record(seqelem, pmid):
+    isolate_name = isolate_date = source = patient = None
+    extra = {}
+    for feature in seqelem.iterfind('GBSeq_feature-table/GBFeature'):
+        if feature.findtext('GBFeature_key') == 'source':
+            quals = [{child.tag: child.text or '' for child in qual}
+                     for qual in feature.iterfind(
+                         'GBFeature_quals/GBQualifier')]
+            isolate_name = pop_from_qualifier(
+                quals, 'isolate', 'strain')
+            isolate_date = pop_from_qualifier(quals, 'collection_date')
+            source = pop_from_qualifier(quals, 'isolation_source')
+    # the IDs efetch may have been given for this record
+    seqids = {seqelem.findtext('GBSeq_primary-accession'),
+              seqelem.findtext('GBSeq_accession-version')}
+    for seqid in seqelem.iterfind('GBSeq_other-seqids/GBSeqid'):
+        if seqid.text.startswith('gi|'):
+            seqids.add(seqid.text[3:])
+    comment = seqelem.findtext('GBSeq_comment')
+    if comment is not None:
+        lanldata = parse_lanl_data(comment)
+        source = lanldata.pop('sample tissue', source)
+        patient = lanldata.pop('patient code', '')
+        extra = lanldata
+    return SequenceTuple(
+        seqelem.findtext('GBSeq_primary-accession'),  # accession
+        seqelem.findtext('GBSeq_accession-version') +
+        ' ' + seqelem.findtext('GBSeq_definition'),   # header
+        seqelem.findtext('GBSeq_sequence').upper(),   # sequence
+        pmid,
+        isolate_name,
+        isolate_date,
+        source,
+        patient,
+        extra,
+        seqids,
+    )
+
+
+def get_sequences(pmid, accs, step=EFETCH_BATCH, workers=EFETCH_WORKERS):
+    """Fetch and parse GenBank records of accessions, in their order
+
+    Records found in ENTREZ_CACHE are not fetched again. Up to
+    ``workers`` efetch batches are downloaded and parsed concurrently
+    while the finished ones are yielded.
+    """
     print('Fetching sequences from GenBank ...')
+    batches = [accs[offset:offset + step]
+               for offset in range(0, len(accs), step)]
     pbar = tqdm(total=len(accs))
-    for offset in range(0, len(accs), step):
-        partial = accs[offset:offset + step]
-        # Entrez.efetch is too slow because it doesn't support gzip
-        resp = requests.post(
-            'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi',
-            data={
-                'db': 'nuccore',
-                'id': ','.join(str(a) for a in partial),
-                'retmode': 'xml'
-            })
-        data = Entrez.read(BytesIO(resp.content))
-        for seqdict in data:
-            isolate_name = isolate_date = source = patient = None
-            extra = {}
-            for feature in seqdict['GBSeq_feature-table']:
-                if feature['GBFeature_key'] == 'source':
-                    quals = feature['GBFeature_quals']
-                    isolate_name = pop_from_qualifier(
-                        quals, 'isolate', 'strain')
-                    isolate_date = pop_from_qualifier(quals, 'collection_date')
-                    source = pop_from_qualifier(quals, 'isolation_source')
-            if 'GBSeq_comment' in seqdict:
-                lanldata = parse_lanl_data(seqdict['GBSeq_comment'])
-                source = lanldata.pop('sample tissue', source)
-                patient = lanldata.pop('patient code', '')
-                extra = lanldata
-            yield SequenceTuple(
-                seqdict['GBSeq_primary-accession'],  # accession
-                seqdict['GBSeq_accession-version'] +
-                ' ' + seqdict['GBSeq_definition'],   # header
-                seqdict['GBSeq_sequence'].upper(),   # sequence
-                pmid,
-                isolate_name,
-                isolate_date,
-                source,
-                patient,
-                extra,
-            )
-        pbar.update(step)
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for batch in batches:
+            batch = [str(acc) for acc in batch]
+            cached = {acc: ENTREZ_CACHE.get('efetch', acc) for acc in batch}
+            missing = [acc for acc in batch if cached[acc] is None]
+            if missing and OFFLINE:
+                raise RuntimeError(
+                    'No cached efetch response of {} in offline mode'
+                    .format(', '.join(missing)))
+            future = executor.submit(fetch_records, pmid, missing) \
+                if missing else None
+            pending.append((batch, cached, missing, future))
+            # keep the next batches in flight while yielding this one
+            if len(pending) > workers:
+                yield from collect_batch(pmid, *pending.popleft(), pbar)
+        while pending:
+            yield from collect_batch(pmid, *pending.popleft(), pbar)
+    pbar.close()
+
+
+def fetch_records(pmid, accs):
+    """Fetch and parse the GenBank records of accessions
+
+    Runs on a worker thread, parsing the efetch response while it is
+    still being received. When the body breaks off, only the IDs not
+    received yet are requested again. Returns the records with their
+    GBSeq XML, in the order received.
+    """
+    received = []
+    missing = list(accs)
+    for attempt in range(EUTILS_RETRIES):
+        try:
+            with fetch_gbseq(missing) as resp:
+                for seqelem in iter_gbseq(resp.raw):
+                    received.append((gbseq_record(seqelem, pmid),
+                                     ElementTree.tostring(seqelem)))
+            break
+        except (requests.RequestException, urllib3.exceptions.HTTPError,
+                ElementTree.ParseError) as exc:
+            if attempt + 1 == EUTILS_RETRIES:
+                raise
+            print('Warning: efetch response broke off ({}), retrying'
+                  .format(exc), file=sys.stderr)
+            seqids = set().union(*(seq.seqids for seq, _ in received))
+            missing = [acc for acc in missing if acc not in seqids]
+            if not missing:
+                break
+    return received
+
+
+def collect_batch(pmid, batch, cached, missing, future, pbar):
+    """Yield the records of a batch in the order of its accessions
+
+    Fetched records are added to ENTREZ_CACHE; the ones that match none
+    of the requested IDs come last.
+    """
+    records = {
+        acc: gbseq_record(ElementTree.fromstring(content), pmid)
+        for acc, content in cached.items() if content is not None
+    }
+    unmatched = []
+    if future is not None:
+        for seq, content in future.result():
+            ENTREZ_CACHE.put('efetch', seq.seqids, content)
+            matched = seq.seqids & set(missing)
+            if not matched:
+                unmatched.append(seq)
+            for acc in matched:
+                records[acc] = seq
+        ENTREZ_CACHE.save()
+    for acc in batch:
+        if acc in records:
+            yield records[acc]
+    yield from unmatched
+    pbar.update(len(batch))
 
 
 def get_sierra_result(sequences):
     seqs = [{'header': s.header, 'sequence': s.sequence}
             for s in sequences]
-    client = sierrapy.SierraClient('https://hivdb.stanford.edu/graphql')
-    client.toggle_progress()
-    with open(SIERRAPY_QUERY) as fp:
+    with open(SIERRA_QUERY) as fp:
         query = fp.read()
-    return client.sequence_analysis(seqs, query)
+    return list(iter_sierra_results(seqs, query))
 
 
 def write_sequences_fact(sequences, sierra_result, fp):
@@ -213,6 +431,11 @@ def single(pmid, accs=None):
     # run sierra
     sierra_result = get_sierra_result(sequences)
 
+    save_study(pmid, sequences, sierra_result)
+    return 0
+
+
+def save_study(pmid, sequences, sierra_result):
     # save sequences fact
     fact_table = os.path.join(LOCALDIR, '{}.sequences.fact.csv'.format(pmid))
     with open(fact_table, 'w') as fp:
@@ -224,6 +447,49 @@ def single(pmid, accs=None):
         write_sierra_result(sierra_result, fp)
     print('- {}'.format(sierra_file), file=sys.stderr)
     print('- {}'.format(fact_table), file=sys.stderr)
+
+
+def multiple(pmids):
+    """Add several studies in one pipeline run
+
+    Accessions of all PMIDs are fetched and analyzed together, once
+    each even when shared by several studies, then split back into the
+    files of each study.
+    """
+    study_accs = {}
+    for pmid in pmids:
+        if not re.match(r'^\d+$', pmid):
+            print('PMID must be a number (received {!r}'
+                  .format(pmid), file=sys.stderr)
+            continue
+        accs = get_accs(pmid)
+        print('Fetching GenBank accession number of {} from Entrez:'
+              .format(pmid),
+              'found {}.'.format(len(accs)) if accs else 'not found.',
+              file=sys.stderr)
+        if accs:
+            study_accs[pmid] = [str(acc) for acc in accs]
+    if not study_accs:
+        return 3
+
+    accs = list(dict.fromkeys(
+        acc for study in study_accs.values() for acc in study))
+    print('{} unique accessions of {} studies'
+          .format(len(accs), len(study_accs)), file=sys.stderr)
+    fetched = list(get_sequences(None, accs))
+    sequences = {seqid: seq for seq in fetched for seqid in seq.seqids}
+    sierra_result = get_sierra_result(fetched)
+    sierra_result = {
+        one['inputSequence']['header'].split('.', 1)[0]: one
+        for one in sierra_result
+    }
+
+    for pmid, accs in study_accs.items():
+        study = [sequences[acc]._replace(pmid=pmid)
+                 for acc in dict.fromkeys(accs) if acc in sequences]
+        save_study(pmid, study, [sierra_result[seq.accession]
+                                 for seq in study
+                                 if seq.accession in sierra_result])
     return 0
 
 
@@ -239,8 +505,8 @@ def main():
                   .format(sys.argv[0]), file=sys.stderr)
             exit(126)
         pmids = sys.argv[2:]
-        for pmid in pmids:
-            single(pmid)
+        retcode = multiple(pmids)
+        exit(retcode)
     else:  # single
         if len(sys.argv) < 3:
             print('Usage: {} single <PMID> [ACCESSION1, ACCESSION2, ...]'
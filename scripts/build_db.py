@@ -10,46 +10,54 @@ import os
 import sys
 import csv
 import json
-from datetime import datetime
+import argparse
 
 import requests
+import numpy as np
 from collections import OrderedDict
 
-DATE_1900 = datetime.strptime('1900-01-01', '%Y-%m-%d')
+from common import (BASEDIR, OFFLINE, FastaStore, atomic_write,
+                    is_transient_http_error, retry)
+
 ESUMMARY_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi'
-PATTERN_MIXTURES = re.compile(r'^[A-Z]{2,}$')
-
-
-def fasta_reader(filename):
-    with open(filename) as fp:
-        header = None
-        seq = []
-        for line in fp:
-            if line.startswith('#'):
-                continue
-            elif line.startswith('>'):
-                if seq:
-                    yield header, ''.join(seq)
-                header = line[1:].strip()
-                seq = []
-            else:
-                seq.append(line.strip())
-        if seq:
-            yield header, ''.join(seq)
+ESUMMARY_BATCH = 200
+ESUMMARY_RETRIES = 5
+ESUMMARY_BACKOFF = 2  # seconds, doubled after each failed attempt
+REFERENCE_STORE = os.path.join(BASEDIR, 'local', 'pubmed', 'references.json')
+PATTERN_MIXTURES = re.compile(r'^[A-Z]{2,}$', re.MULTILINE)
+NON_AMBIGUITIES = bytes(
+    set(range(256)) - set(b'WSMKRYBDHVNwsmkrybdhvn'))
+SHARDS_DIR = 'studies'
+SHARD_SUFFIX = '.ndjson'
+SHARD_INDEX = 'index.json'
+PACK_FILE = 'sequences.pack'
+PACK_INDEX = 'sequences.pack.json'
 
 
-def retrieve_references(pubmed_ids):
-    resp = requests.post(
-        ESUMMARY_URL,
-        data={
-            'db': 'pubmed',
-            'id': ','.join(pubmed_ids),
-            'retmode': 'json'
-        }
-    )
-    data = resp.json()
-    references = OrderedDict()
-    for uid in sorted(data['result']['uids']):
+def fetch_references(pubmed_ids):
+    """Fetch references from NCBI esummary, retrying with backoff"""
+    def fetch():
+        resp = requests.post(
+            ESUMMARY_URL,
+            data={
+                'db': 'pubmed',
+                'id': ','.join(pubmed_ids),
+                'retmode': 'json'
+            },
+            timeout=60
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        if 'result' not in data:
+            raise ValueError(data.get('error', 'no result'))
+        return data
+
+    data = retry(fetch, ESUMMARY_RETRIES, ESUMMARY_BACKOFF,
+                 (requests.RequestException, ValueError),
+                 what='esummary request', retryable=is_transient_http_error)
+
+    references = {}
+    for uid in data['result']['uids']:
         ref = data['result'][uid]
         references[uid] = OrderedDict({
             'MedlineID': uid,
@@ -61,56 +69,149 @@ def retrieve_references(pubmed_ids):
     return references
 
 
-def list_subtypes(seqs):
-    subtypes = set()
-    for seq in seqs:
-        subtypes.add(seq['Subtype'])
-    return sorted(subtypes)
+def load_reference_store():
+    if not os.path.exists(REFERENCE_STORE):
+        return {}
+    with open(REFERENCE_STORE) as fp:
+        return json.load(fp, object_pairs_hook=OrderedDict)
 
 
-def list_sources(seqs):
-    sources = set()
-    for seq in seqs:
-        sources.add(seq['Source'])
-    return sorted(sources)
+def save_reference_store(store):
+    os.makedirs(os.path.dirname(REFERENCE_STORE), exist_ok=True)
+    with atomic_write(REFERENCE_STORE) as fp:
+        json.dump(store, fp, indent=2)
 
 
-def main():
-    facttable, fasta, sierra_report, outputdir = sys.argv[1:]
-    with open(facttable) as fp1, open(sierra_report) as fp2:
-        if fp1.read(1) != '\ufeff':
-            fp1.seek(0)
-        sequences = list(csv.DictReader(fp1))
-        sequence_reports = json.load(fp2)
-    sequence_reports = {
-        sr['inputSequence']['header'].split('.', 1)[0]: sr
+def retrieve_references(pubmed_ids):
+    """Return the references of the given PMIDs, ordered by PMID
+
+    References are kept in REFERENCE_STORE, with null for PMIDs that
+    PubMed did not return. PMIDs missing from the store (or null there)
+    are fetched ESUMMARY_BATCH at a time, and the store is saved after
+    each batch. In OFFLINE mode nothing is fetched and a PMID missing
+    from the store is an error.
+    """
+    store = load_reference_store()
+    if OFFLINE:
+        missing = sorted(set(pubmed_ids) - set(store))
+        if missing:
+            raise RuntimeError(
+                'PMIDs {} are not in {} in offline mode; run `make build` '
+                'on a networked host and copy it'.format(
+                    ', '.join(missing), REFERENCE_STORE))
+        missing = []
+    else:
+        missing = sorted(uid for uid in set(pubmed_ids)
+                         if store.get(uid) is None)
+    for offset in range(0, len(missing), ESUMMARY_BATCH):
+        batch = missing[offset:offset + ESUMMARY_BATCH]
+        store.update(dict.fromkeys(batch), **fetch_references(batch))
+        save_reference_store(store)
+    for uid in sorted(pubmed_ids):
+        if store.get(uid) is None:
+            print('Warning: PMID {} not found in PubMed'.format(uid),
+                  file=sys.stderr)
+
+    references = OrderedDict()
+    for uid in sorted(pubmed_ids):
+        if store.get(uid) is not None:
+            references[uid] = store[uid]
+    return references
+
+
+def read_facttable(facttable):
+    with open(facttable) as fp:
+        if fp.read(1) != '\ufeff':
+            fp.seek(0)
+        yield from csv.DictReader(fp)
+
+
+def gene_stats(gene_seq):
+    """Return (# mixtures, # mutations, # NA ambiguities) of a gene
+
+    Mixtures are matched in one pass over the newline-joined mutation
+    AAs, and ambiguities are counted by deleting every other byte.
+    """
+    mutations = gene_seq['mutations']
+    nummixtures = len(PATTERN_MIXTURES.findall(
+        '\n'.join(m['AAs'] for m in mutations)))
+    numambiguities = len(
+        gene_seq['alignedNAs'].encode().translate(None, NON_AMBIGUITIES))
+    return nummixtures, len(mutations), numambiguities
+
+
+def load_sequence_reports(sierra_report):
+    """Load the subtype and per-gene statistics of each Sierra report
+
+    The statistics are computed while loading, so the reports themselves
+    are not kept in memory.
+    """
+    with open(sierra_report) as fp:
+        sequence_reports = json.load(fp)
+    return {
+        sr['inputSequence']['header'].split('.', 1)[0]: (
+            sr['subtypeText'].split(' (', 1)[0],
+            {gene_seq['gene']['name']: gene_stats(gene_seq)
+             for gene_seq in sr['alignedGeneSequences']}
+        )
         for sr in sequence_reports
     }
-    result_sequences = []
-    pubmed_ids = set()
-
-    min_days_offsets = {}
-    for seq in sequences:
-        pt = seq['PtIdentifier']
-        offset = \
-            datetime.strptime(seq['CollectionDate'], '%Y-%m-%d') - DATE_1900
-        offset = offset.days
-        min_days_offsets[pt] = \
-            min(min_days_offsets.get(pt, 0xffffffff), offset)
-
-    for seq in sequences:
-        pt = seq['PtIdentifier']
-        offset = \
-            datetime.strptime(seq['CollectionDate'], '%Y-%m-%d') - DATE_1900
-        offset = offset.days
-        weeks = int('{:.0f}'.format((offset - min_days_offsets[pt]) / 7))
+
+
+def is_full_date(date):
+    try:
+        np.datetime64(date, 'D')
+    except ValueError:
+        return False
+    return len(date) == 10 and date != 'NaT'
+
+
+def calc_weeks(facttable):
+    """Weeks since the first collection date of the same patient
+
+    Dates are parsed as one datetime64 array and the first date of each
+    patient is computed once.
+    """
+    accs = []
+    ptids = []
+    dates = []
+    for seq in read_facttable(facttable):
+        accs.append(seq['Accession'])
+        ptids.append(seq['PtIdentifier'])
+        dates.append(seq['CollectionDate'])
+    dates = np.array(dates, dtype=str)
+    # datetime64 reads '' as NaT and '2001-05' as 2001-05-01
+    bad = np.char.str_len(dates) != 10
+    if not bad.any():
+        try:
+            parsed = dates.astype('datetime64[D]')
+        except ValueError:
+            bad = np.array([not is_full_date(date) for date in dates])
+        else:
+            bad = np.isnat(parsed)
+    if bad.any():
+        row = int(np.argmax(bad))
+        raise ValueError(
+            'invalid CollectionDate {!r} of {} (row {} of {})'
+            .format(str(dates[row]), accs[row], row + 1, facttable))
+    days = parsed.astype(np.int64)
+    _, ptidx = np.unique(ptids, return_inverse=True)
+    ptidx = ptidx.reshape(-1)
+    min_days = np.full(ptidx.max(initial=-1) + 1, np.iinfo(np.int64).max)
+    np.minimum.at(min_days, ptidx, days)
+    # never a tie: an integer number of days is never x.5 weeks
+    return np.rint((days - min_days[ptidx]) / 7).astype(np.int64).tolist()
+
+
+def build_sequences(facttable, sequence_reports):
+    """Yield the meta.json record of each sequence of the fact table"""
+    weeks = calc_weeks(facttable)
+    for seq, seqweeks in zip(read_facttable(facttable), weeks):
         seq = OrderedDict(seq)
-        pubmed_ids.add(seq['MedlineID'])
         accs = seq['Accession']
-        seqreport = sequence_reports[accs]
-        subtype = seqreport['subtypeText'].split(' (', 1)[0]
+        subtype, stats = sequence_reports[accs]
         seq.update({
-            'Weeks': weeks,
+            'Weeks': seqweeks,
             'PR': 0,
             'RT': 0,
             'IN': 0,
@@ -125,33 +226,134 @@ def main():
             'NumINNAAmbiguities': None,
             'Subtype': subtype,
         })
-        for gene_seq in seqreport['alignedGeneSequences']:
-            gene = gene_seq['gene']['name']
-            seq['Num{}Mixtures'.format(gene)] = len([
-                m for m in gene_seq['mutations']
-                if PATTERN_MIXTURES.match(m['AAs'])])
-            seq['Num{}Mutations'.format(gene)] = len(gene_seq['mutations'])
+        for gene, (nummixtures, nummutations, numambiguities) in \
+                stats.items():
+            seq['Num{}Mixtures'.format(gene)] = nummixtures
+            seq['Num{}Mutations'.format(gene)] = nummutations
             seq[gene] = 1
-            seq['Num{}NAAmbiguities'.format(gene)] = len([
-                n for n in gene_seq['alignedNAs'].upper()
-                if n in 'WSMKRYBDHVN'])
-        result_sequences.append(seq)
-    result_data = OrderedDict({
-        'sequences': result_sequences,
-        'references': retrieve_references(pubmed_ids),
-        'subtypes': list_subtypes(result_sequences),
-        'sources': list_sources(result_sequences),
-    })
+            seq['Num{}NAAmbiguities'.format(gene)] = numambiguities
+        yield seq
+
+
+def write_meta(sequences, references, outputdir):
+    """Stream sequences to meta.json and to one NDJSON shard per study
+
+    Only per-study summaries are kept in memory. They are written to
+    SHARDS_DIR/SHARD_INDEX with the study references, so clients can
+    fetch the shard of a single study instead of the whole meta.json.
+    ``references`` are resolved beforehand, so nothing can fail once
+    meta.json is half-written; it replaces the previous one when done.
+    """
+    shardsdir = os.path.join(outputdir, SHARDS_DIR)
+    os.makedirs(shardsdir, exist_ok=True)
+    for name in os.listdir(shardsdir):
+        if name.endswith(SHARD_SUFFIX):
+            os.remove(os.path.join(shardsdir, name))
+
+    studies = {}
+    subtypes = set()
+    sources = set()
+    shardfp = None
+    pubmed_id = None
     factjson = os.path.join(outputdir, 'meta.json')
-    with open(factjson, 'w') as outfp:
-        json.dump(result_data, outfp)
-
-    # We don't need this anymore
-    # for header, seq in fasta_reader(fasta):
-    #     accs = header.split('.', 1)[0]
-    #     single = os.path.join(outputdir, 'sequences', '{}.json'.format(accs))
-    #     with open(single, 'w') as outfas:
-    #         json.dump({'header': header, 'sequence': seq}, outfas)
+    with atomic_write(factjson) as outfp:
+        # same bytes as json.dump() of the whole OrderedDict
+        outfp.write('{"sequences": [')
+        for idx, seq in enumerate(sequences):
+            if idx:
+                outfp.write(', ')
+            outfp.write(json.dumps(seq))
+            if seq['MedlineID'] != pubmed_id:
+                if shardfp:
+                    shardfp.close()
+                pubmed_id = seq['MedlineID']
+                shardfp = open(os.path.join(
+                    shardsdir, pubmed_id + SHARD_SUFFIX
+                ), 'a' if pubmed_id in studies else 'w')
+                studies.setdefault(pubmed_id, {
+                    'NumSequences': 0,
+                    'Patients': set(),
+                    'Subtypes': set(),
+                    'Sources': set(),
+                })
+            shardfp.write(json.dumps(seq))
+            shardfp.write('\n')
+            study = studies[pubmed_id]
+            study['NumSequences'] += 1
+            study['Patients'].add(seq['PtIdentifier'])
+            study['Subtypes'].add(seq['Subtype'])
+            study['Sources'].add(seq['Source'])
+            subtypes.add(seq['Subtype'])
+            sources.add(seq['Source'])
+        if shardfp:
+            shardfp.close()
+        outfp.write('], "references": ')
+        json.dump(references, outfp)
+        outfp.write(', "subtypes": ')
+        json.dump(sorted(subtypes), outfp)
+        outfp.write(', "sources": ')
+        json.dump(sorted(sources), outfp)
+        outfp.write('}')
+
+    index = OrderedDict({
+        'studies': [OrderedDict({
+            'MedlineID': pubmed_id,
+            'File': pubmed_id + SHARD_SUFFIX,
+            'NumSequences': study['NumSequences'],
+            'NumPatients': len(study['Patients']),
+            'Subtypes': sorted(study['Subtypes']),
+            'Sources': sorted(study['Sources']),
+            'Reference': references.get(pubmed_id),
+        }) for pubmed_id, study in sorted(studies.items())],
+        'subtypes': sorted(subtypes),
+        'sources': sorted(sources),
+    })
+    with atomic_write(os.path.join(shardsdir, SHARD_INDEX)) as outfp:
+        json.dump(index, outfp)
+
+
+def write_sequence_pack(fasta, outputdir):
+    """Write the sequences of the FASTA file back to back in one blob
+
+    PACK_INDEX maps each accession to its header and to the offset and
+    length of the sequence in PACK_FILE, so the web app can fetch a
+    single sequence with a range request.
+    """
+    index = OrderedDict()
+    offset = 0
+    with FastaStore(fasta) as store, \
+            open(os.path.join(outputdir, PACK_FILE), 'wb') as fp:
+        for accs in store:
+            seq = store[accs].encode()
+            fp.write(seq)
+            index[accs] = OrderedDict({
+                'header': store.header(accs),
+                'offset': offset,
+                'length': len(seq),
+            })
+            offset += len(seq)
+    with open(os.path.join(outputdir, PACK_INDEX), 'w') as fp:
+        json.dump(index, fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('facttable')
+    parser.add_argument('fasta')
+    parser.add_argument('sierra_report')
+    parser.add_argument('outputdir')
+    parser.add_argument(
+        '--pack-sequences', action='store_true',
+        help='also write the sequences to {} and {}'
+        .format(PACK_FILE, PACK_INDEX))
+    args = parser.parse_args()
+    references = retrieve_references(
+        {seq['MedlineID'] for seq in read_facttable(args.facttable)})
+    sequence_reports = load_sequence_reports(args.sierra_report)
+    write_meta(build_sequences(args.facttable, sequence_reports),
+               references, args.outputdir)
+    if args.pack_sequences:
+        write_sequence_pack(args.fasta, args.outputdir)
 
 
 if __name__ == '__main__':
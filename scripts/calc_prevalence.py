@@ -1,12 +1,25 @@
 #! /usr/bin/env python
 
+import io
 import os
+import sys
 import csv
+import json
+import pickle
+import hashlib
+import argparse
+import multiprocessing as mp
 
 from decimal import Decimal
+from functools import partial
 from collections import OrderedDict, Counter, defaultdict
 
-from common import load_sequences, apobec_mutation_map, BASEDIR, PREC3
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from common import (load_sequences, apobec_mutation_table, annotation_matrix,
+                    popcount, atomic_write, BASEDIR, PREC3, ALL_AAS,
+                    AA_CODES, NUM_AAS, SPARSE_PREVALENCE, SPARSE_TEXT_COLUMNS)
 
 OUTPUTS = {
     'PR': os.path.join(BASEDIR, 'data', 'prevalence', 'SGS.PRprevalence.csv'),
@@ -14,7 +27,29 @@ OUTPUTS = {
     'IN': os.path.join(BASEDIR, 'data', 'prevalence', 'SGS.INprevalence.csv'),
 }
 
-APM = apobec_mutation_map()
+PREVALENCE_STATE = os.path.join(
+    BASEDIR, 'local', 'prevalence', 'SGS.{}prevalence.state.pickle')
+STATE_VERSION = 4
+
+APOBECS = apobec_mutation_table()
+
+GENES = ('PR', 'RT', 'IN')
+
+NOT_COVERED = NUM_AAS
+
+CATEGORIES = OrderedDict([
+    ('All', lambda s, rx: True),
+    ('SubtypeB', lambda s, rx: s == 'B'),
+    ('SubtypeC', lambda s, rx: s == 'C'),
+    ('Non-SubtypeBC', lambda s, rx: s not in ('B', 'C')),
+    ('ART', lambda s, rx: rx == 'ART'),
+    ('Naive', lambda s, rx: rx == 'None'),
+])
+
+HEADER = ['Gene', 'Category', 'Pos', 'AA', 'FromCodons', 'ToCodons',
+          'FromCodonsCtx', 'ToCodonsCtx', 'Pcnt', 'Count', 'PosTotal',
+          'PatientCount', 'PatientPosTotal', 'SampleCount',
+          'SamplePosTotal', 'IsAPOBEC']
 
 CONSENSUS = {
     'PR': (
@@ -101,131 +136,758 @@ def displaycodons(codoncounter):
     return ', '.join(tpl.format(*c) for c in codoncounter.most_common())
 
 
-def othercodons(ptids, codons, exclude_codons):
-    result = Counter()
-    for ptid, ptcodons in codons.items():
-        if ptid in ptids:
-            result += ptcodons
-    for codon in exclude_codons:
-        result.pop(codon)
-    return displaycodons(result)
-
-
-def aggregate_aa_prevalence(gene, sequences,
-                            category, category_func):
-    result = OrderedDict()
-    total = Counter()
-    totalpt = defaultdict(set)
-    resultpt = defaultdict(set)
-    totalspl = defaultdict(set)
-    resultspl = defaultdict(set)
-    all_aas = list('ACDEFGHIKLMNPQRSTVWY-_X*')
+def othercodons(ptaas, ptcodons, aacodons):
+    """FromCodons of every AA at one position
+
+    Each patient's codon totals at the position are added once to every
+    AA the patient carries there; the codons of the AA itself are then
+    dropped.
+    """
+    result = defaultdict(Counter)
+    for ptidx, codons in ptcodons.items():
+        for aa in ptaas[ptidx]:
+            result[aa].update(codons)
+    for aa, counter in result.items():
+        for codon in aacodons[aa]:
+            counter.pop(codon)
+    return {aa: displaycodons(counter) for aa, counter in result.items()}
+
+
+def bitset(indices):
+    """Bitset of integer ids, built in one pass over a byte buffer"""
+    buf = bytearray((max(indices, default=0) >> 3) + 1)
+    for idx in indices:
+        buf[idx >> 3] |= 1 << (idx & 7)
+    return int.from_bytes(buf, 'little')
+
+
+def bit_indices(bits):
+    """Indices of the set bits of a bitset, in increasing order"""
+    return [idx for idx, bit in enumerate(reversed(bin(bits))) if bit == '1']
+
+
+def intern_id(index, key):
+    """Map key to a dense integer id, in order of first appearance"""
+    return index.setdefault(key, len(index))
+
+
+def find_gene_sequence(gene, seqfact):
+    for gseq in seqfact['_Sierra']['alignedGeneSequences']:
+        if gseq['gene']['name'] == gene:
+            return gseq
+
+
+def mutation_aa(mut):
+    if mut['isInsertion']:
+        return '_'
+    elif mut['isDeletion']:
+        return '-'
+    aa = mut['AAs']
+    if len(aa) > 1:
+        aa = 'X'
+    return aa
+
+
+def iter_aa_cells(gene, seqfact):
+    """Yield (pos, aa, codon, shortcodon) of every covered gene position"""
+    gseq = find_gene_sequence(gene, seqfact)
+    if gseq is None:
+        return
     consensus = CONSENSUS[gene]
-    genesize = len(consensus)
-    codons = defaultdict(Counter)
-    shortcodons = defaultdict(Counter)
-    codonspt = defaultdict(lambda: defaultdict(Counter))
-    shortcodonspt = defaultdict(lambda: defaultdict(Counter))
+    muts = {m['position']: m for m in gseq['mutations']}
+    aligned_nas = gseq['alignedNAs']
+    first_aa = max(1, gseq['firstAA'])
+    last_aa = min(len(consensus), gseq['lastAA'])
+    for pos in range(first_aa, last_aa + 1):
+        if pos in muts:
+            aa = mutation_aa(muts[pos])
+        else:
+            aa = consensus[pos - 1]
+        relpos = pos - gseq['firstAA'] + 1
+        codon = aligned_nas[max(0, (relpos - 2) * 3):(relpos + 1) * 3]
+        shortcodon = aligned_nas[relpos * 3 - 3:relpos * 3]
+        yield pos, aa, codon, shortcodon
+
+
+class AAPrevalence:
+    """Additive prevalence state of one gene/category pair"""
 
-    for pos in range(1, genesize + 1):
-        for aa in all_aas:
-            result[(pos, aa)] = 0
+    def __init__(self, gene, category):
+        self.gene = gene
+        self.category = category
+        self.result = Counter()
+        self.total = Counter()
+        # distinct patients and samples are bitsets of interned ids
+        self.totalpt = defaultdict(int)
+        self.resultpt = defaultdict(int)
+        self.totalspl = defaultdict(int)
+        self.resultspl = defaultdict(int)
+        self.codons = defaultdict(Counter)
+        self.shortcodons = defaultdict(Counter)
+        # partials instead of lambdas keep the state picklable
+        self.codonspt = defaultdict(partial(defaultdict, Counter))
+        self.shortcodonspt = defaultdict(partial(defaultdict, Counter))
 
+    def rows(self):
+        gene = self.gene
+        genesize = len(CONSENSUS[gene])
+        apobecs = annotation_matrix(APOBECS, gene, genesize).tolist()
+        for pos in range(1, genesize + 1):
+            shortcodons = {aa: self.shortcodons.get((pos, aa), Counter())
+                           for aa in ALL_AAS}
+            codons = {aa: self.codons.get((pos, aa), Counter())
+                      for aa in ALL_AAS}
+            # AAs of each patient, from the patient bitsets of the AAs
+            ptaas = defaultdict(list)
+            for aa in ALL_AAS:
+                for ptidx in bit_indices(self.resultpt.get((pos, aa), 0)):
+                    ptaas[ptidx].append(aa)
+            fromcodons = othercodons(
+                ptaas, self.shortcodonspt.get(pos, {}), shortcodons)
+            fromcodonsctx = othercodons(
+                ptaas, self.codonspt.get(pos, {}), codons)
+            for code, aa in enumerate(ALL_AAS):
+                yield prevalence_row(
+                    gene, self.category, pos, aa,
+                    from_codons=fromcodons.get(aa, ''),
+                    to_codons=displaycodons(shortcodons[aa]),
+                    from_codons_ctx=fromcodonsctx.get(aa, ''),
+                    to_codons_ctx=displaycodons(codons[aa]),
+                    count=self.result[(pos, aa)],
+                    total=self.total[pos],
+                    ptcount=popcount(self.resultpt.get((pos, aa), 0)),
+                    pttotal=popcount(self.totalpt.get(pos, 0)),
+                    splcount=popcount(self.resultspl.get((pos, aa), 0)),
+                    spltotal=popcount(self.totalspl.get(pos, 0)),
+                    is_apobec=apobecs[pos][code])
+
+
+class SequenceTallies:
+    """Flat tallies of sequences, keyed first by their category group
+
+    Each sequence is tallied once under the group of categories it
+    matched; merge_tallies() then folds every group into each of its
+    categories, so the per-cell work does not grow with the number
+    of categories a sequence counts for.
+    """
+
+    def __init__(self):
+        self.result = {}
+        self.codons = {}
+        self.shortcodons = {}
+        self.codonspt = {}
+        self.shortcodonspt = {}
+        # patient and sample ids of each cell; merge_tallies() turns each
+        # list into a bitset once instead of ORing in a bit per cell
+        self.resultpt = {}
+        self.resultspl = {}
+
+    def add(self, group, ptidx, splidx, cells):
+        # dict.get instead of Counter: new keys are the common case here,
+        # and Counter.__missing__ is a Python call per new key
+        result = self.result
+        codons = self.codons
+        shortcodons = self.shortcodons
+        codonspt = self.codonspt
+        shortcodonspt = self.shortcodonspt
+        resultpt = self.resultpt
+        resultspl = self.resultspl
+        for pos, aa, codon, shortcodon in cells:
+            cell = (group, pos, aa)
+            count = result.get(cell, 0)
+            result[cell] = count + 1
+            if count:
+                resultpt[cell].append(ptidx)
+                resultspl[cell].append(splidx)
+            else:
+                resultpt[cell] = [ptidx]
+                resultspl[cell] = [splidx]
+            key = (group, pos, aa, codon)
+            codons[key] = codons.get(key, 0) + 1
+            key = (group, pos, aa, shortcodon)
+            shortcodons[key] = shortcodons.get(key, 0) + 1
+            key = (group, pos, ptidx, codon)
+            codonspt[key] = codonspt.get(key, 0) + 1
+            key = (group, pos, ptidx, shortcodon)
+            shortcodonspt[key] = shortcodonspt.get(key, 0) + 1
+
+
+def merge_tallies(tallies, targets):
+    """Fold SequenceTallies into the AAPrevalence of each category
+
+    ``targets`` maps each group to the AAPrevalence states of its
+    categories. Tallies are in order of first appearance, so the
+    counters get their keys in the same order as one pass over the
+    sequences would insert them.
+    """
+    def states(name):
+        return {group: [getattr(prev, name) for prev in prevs]
+                for group, prevs in targets.items()}
+
+    results = states('result')
+    totals = states('total')
+    for (group, pos, aa), count in tallies.result.items():
+        for result, total in zip(results[group], totals[group]):
+            result[(pos, aa)] += count
+            total[pos] += count
+    for name, totalname in (('resultpt', 'totalpt'),
+                            ('resultspl', 'totalspl')):
+        results = states(name)
+        totals = states(totalname)
+        for (group, pos, aa), ids in getattr(tallies, name).items():
+            bits = bitset(ids)
+            for result, total in zip(results[group], totals[group]):
+                result[(pos, aa)] |= bits
+                total[pos] |= bits
+    for name in ('codons', 'shortcodons'):
+        codonses = states(name)
+        for (group, pos, aa, codon), count in \
+                getattr(tallies, name).items():
+            for codons in codonses[group]:
+                counter = codons[(pos, aa)]
+                counter[codon] = counter.get(codon, 0) + count
+    for name in ('codonspt', 'shortcodonspt'):
+        codonses = states(name)
+        for (group, pos, ptidx, codon), count in \
+                getattr(tallies, name).items():
+            for codons in codonses[group]:
+                counter = codons[pos][ptidx]
+                counter[codon] = counter.get(codon, 0) + count
+
+
+def tally_sequences(gene, sequences, categories, ptids, spls):
+    """Tally sequences under the tuple of categories each one matched
+
+    Returns the group index of each tuple and the SequenceTallies;
+    patients and samples are interned into ``ptids`` and ``spls``.
+    """
+    groups = {}
+    tallies = SequenceTallies()
     for seqfact in sequences:
-        seq = seqfact['_Sierra']
-        seq_subtype = seq['subtypeText'].split(' (', 1)[0]
-        if not category_func(seq_subtype, seqfact['Rx']):
+        seq_subtype = seqfact['_Sierra']['subtypeText'].split(' (', 1)[0]
+        matched = tuple(cat for cat, func in categories.items()
+                        if func(seq_subtype, seqfact['Rx']))
+        if not matched:
             continue
-        for gseq in seq['alignedGeneSequences']:
-            if gseq['gene']['name'] == gene:
-                break
-        else:
+        cells = list(iter_aa_cells(gene, seqfact))
+        if not cells:
             continue
-        muts = {m['position']: m for m in gseq['mutations']}
-        aligned_nas = gseq['alignedNAs']
-        first_aa = gseq['firstAA']
-        last_aa = gseq['lastAA']
-        for pos in range(1, genesize + 1):
-            if pos < first_aa or pos > last_aa:
-                continue
-            cons = consensus[pos - 1]
-            if pos in muts:
-                mut = muts[pos]
-                if mut['isInsertion']:
-                    aa = '_'
-                elif mut['isDeletion']:
-                    aa = '-'
-                else:
-                    aa = mut['AAs']
-                    if len(aa) > 1:
-                        aa = 'X'
-            else:
-                aa = cons
-            result[(pos, aa)] += 1
-            relpos = pos - first_aa + 1
-            total[pos] += 1
-            codon = aligned_nas[max(0, (relpos - 2) * 3):(relpos + 1) * 3]
-            shortcodon = aligned_nas[relpos * 3 - 3:relpos * 3]
-            ptid = seqfact['PtIdentifier']
-            tp = seqfact['CollectionDate']
-            codons[(pos, aa)][codon] += 1
-            shortcodons[(pos, aa)][shortcodon] += 1
-            codonspt[pos][ptid][codon] += 1
-            shortcodonspt[pos][ptid][shortcodon] += 1
-            resultpt[(pos, aa)].add(ptid)
-            totalpt[pos].add(ptid)
-            resultspl[(pos, aa)].add((ptid, tp))
-            totalspl[pos].add((ptid, tp))
-    return OrderedDict(((pos, aa), {
+        ptid = seqfact['PtIdentifier']
+        ptidx = intern_id(ptids, ptid)
+        splidx = intern_id(spls, (ptid, seqfact['CollectionDate']))
+        tallies.add(intern_id(groups, matched), ptidx, splidx, cells)
+    return groups, tallies
+
+
+def group_targets(groups, prevalences):
+    """Map each group to the AAPrevalence of the categories it matched"""
+    return {group: [prevalences[cat] for cat in matched
+                    if cat in prevalences]
+            for matched, group in groups.items()}
+
+
+def prevalence_row(gene, category, pos, aa, *,
+                   from_codons, to_codons, from_codons_ctx, to_codons_ctx,
+                   count, total, ptcount, pttotal, splcount, spltotal,
+                   is_apobec):
+    return {
         'Gene': gene,
         'Category': category,
         'Pos': pos,
         'AA': aa,
         # 'NACons': NA_CONSENSUS[gene][max(0, (pos - 2) * 3):(pos + 1) * 3],
-        'FromCodons': othercodons(
-            resultpt[(pos, aa)], shortcodonspt[pos], shortcodons[(pos, aa)]
-        ),
-        'ToCodons': displaycodons(shortcodons[(pos, aa)]),
-        'FromCodonsCtx': othercodons(
-            resultpt[(pos, aa)], codonspt[pos], codons[(pos, aa)]
-        ),
-        'ToCodonsCtx': displaycodons(codons[(pos, aa)]),
-        'Pcnt': Decimal(count /
-                        (total[pos] or 0.001) * 100).quantize(PREC3),
+        'FromCodons': from_codons,
+        'ToCodons': to_codons,
+        'FromCodonsCtx': from_codons_ctx,
+        'ToCodonsCtx': to_codons_ctx,
+        'Pcnt': Decimal(count / (total or 0.001) * 100).quantize(PREC3),
         'Count': count,
-        'PosTotal': total[pos],
-        'PatientCount': len(resultpt[(pos, aa)]),
-        'PatientPosTotal': len(totalpt[pos]),
-        'SampleCount': len(resultspl[(pos, aa)]),
-        'SamplePosTotal': len(totalspl[pos]),
-        'IsAPOBEC': (gene, pos, aa) in APM,
-    }) for (pos, aa), count in result.items())
+        'PosTotal': total,
+        'PatientCount': ptcount,
+        'PatientPosTotal': pttotal,
+        'SampleCount': splcount,
+        'SamplePosTotal': spltotal,
+        'IsAPOBEC': is_apobec,
+    }
 
 
-def main():
-    categories = {
-        'All': lambda s, rx: True,
-        'SubtypeB': lambda s, rx: s == 'B',
-        'SubtypeC': lambda s, rx: s == 'C',
-        'Non-SubtypeBC': lambda s, rx: s not in ('B', 'C'),
-        'ART': lambda s, rx: rx == 'ART',
-        'Naive': lambda s, rx: rx == 'None'
+class GeneAggregation:
+    """Additive AA prevalence state of one gene over all categories
+
+    Besides the AAPrevalence of each category, it keeps the interned
+    patient/sample ids and a fingerprint of every sequence folded in, so
+    a persisted state can be extended with newly appended sequences.
+    """
+
+    def __init__(self, gene, categories):
+        self.version = STATE_VERSION
+        self.gene = gene
+        self.prevalences = OrderedDict(
+            (cat, AAPrevalence(gene, cat)) for cat in categories)
+        self.ptids = {}
+        self.spls = {}
+        self.fingerprints = []
+
+    def extend(self, sequences, categories):
+        gene = self.gene
+        for seqfact in sequences:
+            self.fingerprints.append(
+                (seqfact['Accession'], sequence_fingerprint(gene, seqfact)))
+        groups, tallies = tally_sequences(
+            gene, sequences, categories, self.ptids, self.spls)
+        merge_tallies(tallies, group_targets(groups, self.prevalences))
+
+
+def sequence_fingerprint(gene, seqfact):
+    """Digest of everything a sequence contributes to one gene"""
+    payload = json.dumps([
+        seqfact['PtIdentifier'],
+        seqfact['CollectionDate'],
+        seqfact['Rx'],
+        seqfact['_Sierra']['subtypeText'].split(' (', 1)[0],
+        find_gene_sequence(gene, seqfact),
+    ], sort_keys=True, default=lambda gseq: gseq.to_dict())
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def load_aggregation_state(gene, sequences, categories=CATEGORIES):
+    """Load the persisted state of gene and fold in appended sequences
+
+    The state is only reused if the sequences it has seen are an
+    unchanged prefix of ``sequences``; otherwise it is rebuilt from
+    scratch, so the output always equals a full run.
+    """
+    path = PREVALENCE_STATE.format(gene)
+    agg = None
+    if os.path.exists(path):
+        with open(path, 'rb') as fp:
+            agg = pickle.load(fp)
+    if (
+        agg is None or
+        getattr(agg, 'version', None) != STATE_VERSION or
+        list(agg.prevalences) != list(categories) or
+        len(agg.fingerprints) > len(sequences)
+    ):
+        agg = None
+    else:
+        for (acc, fingerprint), seqfact in zip(agg.fingerprints, sequences):
+            if (
+                acc != seqfact['Accession'] or
+                fingerprint != sequence_fingerprint(gene, seqfact)
+            ):
+                agg = None
+                break
+    if agg is None:
+        print('{}: rebuilding prevalence from {} sequences'
+              .format(gene, len(sequences)), file=sys.stderr)
+        agg = GeneAggregation(gene, categories)
+    else:
+        print('{}: folding in {} new sequences'
+              .format(gene, len(sequences) - len(agg.fingerprints)),
+              file=sys.stderr)
+    agg.extend(sequences[len(agg.fingerprints):], categories)
+    return agg
+
+
+def save_aggregation_state(agg):
+    path = PREVALENCE_STATE.format(agg.gene)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write(path, 'wb') as fp:
+        pickle.dump(agg, fp, pickle.HIGHEST_PROTOCOL)
+
+
+def aggregate_aa_prevalence(gene, sequences, categories=CATEGORIES):
+    """Aggregate AA prevalence of every category in one sequence pass"""
+    agg = GeneAggregation(gene, categories)
+    agg.extend(sequences, categories)
+    return agg.prevalences
+
+
+def encode_gene_cells(gene, sequences, categories=CATEGORIES):
+    """Category groups and SequenceTallies of one gene's sequences
+
+    category_prevalence() then aggregates any one category from them.
+    """
+    return tally_sequences(gene, sequences, categories, {}, {})
+
+
+def category_prevalence(gene, category, catidx, encoded):
+    """AAPrevalence of one category from encode_gene_cells()"""
+    groups, tallies = encoded
+    prev = AAPrevalence(gene, category)
+    merge_tallies(tallies, group_targets(groups, {category: prev}))
+    return prev
+
+
+def encode_gene_matrix(gene, sequences):
+    """Encode one gene of sequences into dense (n x genesize) matrices
+
+    Returns the AA code matrix (NOT_COVERED outside firstAA-lastAA) and
+    the matching short codon (S3) and codon context (S9) matrices.
+    """
+    consensus = CONSENSUS[gene]
+    genesize = len(consensus)
+    cons_codes = np.array([AA_CODES[aa] for aa in consensus], dtype=np.uint8)
+    aas = np.full((len(sequences), genesize), NOT_COVERED, dtype=np.uint8)
+    shortcodons = np.zeros((len(sequences), genesize), dtype='S3')
+    codons = np.zeros((len(sequences), genesize), dtype='S9')
+    for idx, seqfact in enumerate(sequences):
+        gseq = find_gene_sequence(gene, seqfact)
+        if gseq is None:
+            continue
+        first_aa = max(1, gseq['firstAA'])
+        last_aa = min(genesize, gseq['lastAA'])
+        if first_aa > last_aa:
+            continue
+        aas[idx, first_aa - 1:last_aa] = cons_codes[first_aa - 1:last_aa]
+        for mut in gseq['mutations']:
+            pos = mut['position']
+            if first_aa <= pos <= last_aa:
+                aas[idx, pos - 1] = AA_CODES[mutation_aa(mut)]
+
+        # relative positions of first_aa and last_aa in alignedNAs;
+        # NUL paddings are dropped by numpy bytes, same as a short slice
+        relfirst = first_aa - gseq['firstAA'] + 1
+        rellast = last_aa - gseq['firstAA'] + 1
+        nas = np.frombuffer(
+            gseq['alignedNAs'].encode('ascii') + b'\0' * (rellast * 3 + 9),
+            dtype=np.uint8)
+        shortcodons[idx, first_aa - 1:last_aa] = \
+            nas[:rellast * 3].view('S3')[relfirst - 1:]
+        # context of relpos r is alignedNAs[(r - 2) * 3:(r + 1) * 3]
+        windows = sliding_window_view(nas, 9)[::3]
+        ctxfirst = max(2, relfirst)
+        codons[idx, first_aa - 1 + ctxfirst - relfirst:last_aa] = (
+            np.ascontiguousarray(windows[ctxfirst - 2:rellast - 1])
+            .view('S9')[:, 0]
+        )
+        if relfirst == 1:
+            codons[idx, first_aa - 1] = gseq['alignedNAs'][:6]
+    return aas, shortcodons, codons
+
+
+def _display_tallies(cells, codons, counts, orders, names):
+    """Format codon tallies like displaycodons(), grouped by cell"""
+    result = {}
+    sort = np.lexsort((orders, -counts, cells))
+    cells = cells[sort].tolist()
+    codons = [names[c] for c in codons[sort].tolist()]
+    counts = counts[sort].tolist()
+    bounds = [0, *(np.flatnonzero(np.diff(cells)) + 1).tolist(), len(cells)]
+    for start, stop in zip(bounds, bounds[1:]):
+        if start == stop:
+            continue
+        if counts[start] > 1:
+            result[cells[start]] = ', '.join(
+                '{} ({})'.format(codon, count) for codon, count in
+                zip(codons[start:stop], counts[start:stop]))
+        else:
+            result[cells[start]] = ', '.join(codons[start:stop])
+    return result
+
+
+def _group_keys(keys, orders):
+    """Unique keys with their counts and the order of first occurrence"""
+    uniq, inverse, counts = np.unique(
+        keys, return_inverse=True, return_counts=True)
+    firsts = np.full(len(uniq), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(firsts, inverse, orders)
+    return uniq, counts, firsts
+
+
+def _to_codons(cell, codon, seqidx, ncodons, names):
+    keys = cell * ncodons + codon
+    uniq, counts, firsts = _group_keys(keys, seqidx)
+    return uniq, _display_tallies(
+        uniq // ncodons, uniq % ncodons, counts, firsts, names)
+
+
+def _from_codons(cell, pospt, codon, seqidx, ncodons, nseqs,
+                 excludes, names):
+    """Vectorized othercodons() of every cell
+
+    Tallies each patient's codons at a position, then joins them to the
+    cells where that patient carries the AA. Ties are broken by the
+    order othercodons() inserts them: patient first, then codon.
+    """
+    npospt = int(pospt.max()) + 1 if len(pospt) else 1
+    ptuniq, _, ptfirsts = _group_keys(pospt, seqidx)
+    pcuniq, pccounts, pcfirsts = _group_keys(pospt * ncodons + codon, seqidx)
+    pcpospt = pcuniq // ncodons
+    pcorders = ptfirsts[np.searchsorted(ptuniq, pcpospt)] * nseqs + pcfirsts
+
+    members = np.unique(cell * npospt + pospt)
+    mcell = members // npospt
+    mpospt = members % npospt
+    lo = np.searchsorted(pcpospt, mpospt, 'left')
+    hi = np.searchsorted(pcpospt, mpospt, 'right')
+    lengths = hi - lo
+    starts = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+    pcidx = starts + np.arange(lengths.sum())
+    jcell = np.repeat(mcell, lengths)
+    jkeys = jcell * ncodons + pcuniq[pcidx] % ncodons
+    keep = ~np.isin(jkeys, excludes)
+    jkeys = jkeys[keep]
+    pcidx = pcidx[keep]
+
+    uniq, inverse = np.unique(jkeys, return_inverse=True)
+    counts = np.zeros(len(uniq), dtype=np.int64)
+    np.add.at(counts, inverse, pccounts[pcidx])
+    orders = np.full(len(uniq), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(orders, inverse, pcorders[pcidx])
+    return _display_tallies(
+        uniq // ncodons, uniq % ncodons, counts, orders, names)
+
+
+class AAPrevalenceMatrix:
+    """Prevalence of one gene/category pair computed from dense matrices"""
+
+    def __init__(self, gene, category, aas, shortcodons, codons,
+                 ptids, spls, nseqs):
+        self.gene = gene
+        self.category = category
+        genesize = len(CONSENSUS[gene])
+        ncells = genesize * NUM_AAS
+        seqidx, posidx = np.nonzero(aas != NOT_COVERED)
+        cell = posidx * NUM_AAS + aas[seqidx, posidx]
+        ptid = ptids[seqidx]
+        spl = spls[seqidx]
+        npts = int(ptids.max()) + 1 if len(ptids) else 1
+        nspls = int(spls.max()) + 1 if len(spls) else 1
+
+        self.count = np.bincount(cell, minlength=ncells).reshape(
+            genesize, NUM_AAS)
+        self.total = self.count.sum(axis=1)
+        ptcells = np.unique(cell * npts + ptid) // npts
+        self.ptcount = np.bincount(ptcells, minlength=ncells).reshape(
+            genesize, NUM_AAS)
+        self.pttotal = np.bincount(
+            np.unique(posidx * npts + ptid) // npts, minlength=genesize)
+        splcells = np.unique(cell * nspls + spl) // nspls
+        self.splcount = np.bincount(splcells, minlength=ncells).reshape(
+            genesize, NUM_AAS)
+        self.spltotal = np.bincount(
+            np.unique(posidx * nspls + spl) // nspls, minlength=genesize)
+
+        pospt = posidx * npts + ptid
+        self.displays = {}
+        for name, matrix in (('short', shortcodons), ('ctx', codons)):
+            names, codon = np.unique(
+                matrix[seqidx, posidx], return_inverse=True)
+            ncodons = max(1, len(names))
+            names = [name.decode() for name in names.tolist()]
+            excludes, to_display = _to_codons(
+                cell, codon, seqidx, ncodons, names)
+            from_display = _from_codons(
+                cell, pospt, codon, seqidx, ncodons, nseqs, excludes, names)
+            self.displays[name] = (from_display, to_display)
+
+    def rows(self):
+        gene = self.gene
+        from_short, to_short = self.displays['short']
+        from_ctx, to_ctx = self.displays['ctx']
+        genesize = len(CONSENSUS[gene])
+        apobecs = annotation_matrix(APOBECS, gene, genesize).tolist()
+        for pos in range(1, genesize + 1):
+            for code, aa in enumerate(ALL_AAS):
+                cell = (pos - 1) * NUM_AAS + code
+                yield prevalence_row(
+                    gene, self.category, pos, aa,
+                    from_codons=from_short.get(cell, ''),
+                    to_codons=to_short.get(cell, ''),
+                    from_codons_ctx=from_ctx.get(cell, ''),
+                    to_codons_ctx=to_ctx.get(cell, ''),
+                    count=int(self.count[pos - 1, code]),
+                    total=int(self.total[pos - 1]),
+                    ptcount=int(self.ptcount[pos - 1, code]),
+                    pttotal=int(self.pttotal[pos - 1]),
+                    splcount=int(self.splcount[pos - 1, code]),
+                    spltotal=int(self.spltotal[pos - 1]),
+                    is_apobec=apobecs[pos][code])
+
+
+def encode_gene_numpy(gene, sequences, categories=CATEGORIES):
+    """Category masks, gene matrices and interned ids of one gene
+
+    Only sequences matching a category and covering the gene are kept;
+    category_prevalence_numpy() then aggregates any one category.
+    """
+    masks = []
+    matched = []
+    for seqfact in sequences:
+        seq_subtype = seqfact['_Sierra']['subtypeText'].split(' (', 1)[0]
+        mask = [func(seq_subtype, seqfact['Rx'])
+                for func in categories.values()]
+        if any(mask) and find_gene_sequence(gene, seqfact) is not None:
+            masks.append(mask)
+            matched.append(seqfact)
+    masks = np.array(masks, dtype=bool).reshape(
+        len(matched), len(categories))
+    aas, shortcodons, codons = encode_gene_matrix(gene, matched)
+    ptids = {}
+    spls = {}
+    ptidx = np.array([
+        intern_id(ptids, s['PtIdentifier']) for s in matched
+    ], dtype=np.int64)
+    splidx = np.array([
+        intern_id(spls, (s['PtIdentifier'], s['CollectionDate']))
+        for s in matched
+    ], dtype=np.int64)
+    return masks, aas, shortcodons, codons, ptidx, splidx
+
+
+def category_prevalence_numpy(gene, category, catidx, encoded):
+    """AAPrevalenceMatrix of one category from encode_gene_numpy()"""
+    masks, aas, shortcodons, codons, ptidx, splidx = encoded
+    mask = masks[:, catidx]
+    return AAPrevalenceMatrix(
+        gene, category, aas[mask], shortcodons[mask], codons[mask],
+        ptidx[mask], splidx[mask], len(masks))
+
+
+def aggregate_aa_prevalence_numpy(gene, sequences, categories=CATEGORIES):
+    """NumPy backend of aggregate_aa_prevalence()"""
+    encoded = encode_gene_numpy(gene, sequences, categories)
+    prevalences = OrderedDict()
+    for catidx, cat in enumerate(categories):
+        prevalences[cat] = category_prevalence_numpy(
+            gene, cat, catidx, encoded)
+    return prevalences
+
+
+BACKENDS = {
+    'python': aggregate_aa_prevalence,
+    'numpy': aggregate_aa_prevalence_numpy,
+}
+
+# per-gene encoding and per-category aggregation of each backend, so
+# --jobs encodes every gene once and units only aggregate a category
+UNIT_BACKENDS = {
+    'python': (encode_gene_cells, category_prevalence),
+    'numpy': (encode_gene_numpy, category_prevalence_numpy),
+}
+
+
+def write_sparse_prevalence(path, gene, sparse):
+    """Write non-zero prevalence cells column by column
+
+    ``sparse`` maps each category to its non-zero rows, in (Pos, AA)
+    order. Rows of one category are contiguous; ``offsets`` indexes them
+    and load_sparse_prevalence() in common.py reads them back.
+    """
+    rows = [row for catrows in sparse.values() for row in catrows]
+    columns = {
+        'gene': np.array(gene),
+        'categories': np.array(list(sparse)),
+        'offsets': np.cumsum(
+            [0] + [len(catrows) for catrows in sparse.values()],
+            dtype=np.int64),
+        'aas': np.array(ALL_AAS),
+        'Pos': np.array([r['Pos'] for r in rows], dtype=np.uint16),
+        'AA': np.array([AA_CODES[r['AA']] for r in rows], dtype=np.uint8),
+        'Pcnt': np.array([r['Pcnt'] for r in rows], dtype=np.float64),
+        'IsAPOBEC': np.array([r['IsAPOBEC'] for r in rows], dtype=bool),
     }
-    header = ['Gene', 'Category', 'Pos', 'AA', 'FromCodons', 'ToCodons',
-              'FromCodonsCtx', 'ToCodonsCtx', 'Pcnt', 'Count', 'PosTotal',
-              'PatientCount', 'PatientPosTotal', 'SampleCount',
-              'SamplePosTotal', 'IsAPOBEC']
-    sequences = load_sequences(filtered=True)
-    for gene in ('PR', 'RT', 'IN'):
-        all_prevalence = []
-        for cat, func in categories.items():
-            prevs = aggregate_aa_prevalence(
-                gene, sequences, cat, func).values()
-            all_prevalence.extend(prevs)
+    for name in ('Count', 'PosTotal', 'PatientCount', 'PatientPosTotal',
+                 'SampleCount', 'SamplePosTotal'):
+        columns[name] = np.array([r[name] for r in rows], dtype=np.int32)
+    for name in SPARSE_TEXT_COLUMNS:
+        texts = [r[name].encode() for r in rows]
+        columns[name + '_offsets'] = np.cumsum(
+            [0] + [len(text) for text in texts], dtype=np.int64)
+        columns[name + '_data'] = np.frombuffer(
+            b''.join(texts), dtype=np.uint8)
+    np.savez(path, **columns)
+
+
+# genes encoded by the parent, shared with forked workers by
+# copy-on-write, so they are neither pickled nor encoded per task
+_SHARED_GENES = {}
+
+
+def prevalence_csv(gene, category, backend, sparse=False):
+    """Aggregate one gene/category unit
+
+    Returns the headerless CSV text of the unit, and its non-zero rows
+    when ``sparse`` is set (None otherwise).
+    """
+    _, prevalence = UNIT_BACKENDS[backend]
+    prev = prevalence(gene, category, list(CATEGORIES).index(category),
+                      _SHARED_GENES[gene])
+    rows = prev.rows()
+    nonzero = None
+    if sparse:
+        rows = list(rows)
+        nonzero = [row for row in rows if row['Count']]
+    fp = io.StringIO()
+    writer = csv.DictWriter(fp, HEADER)
+    writer.writerows(rows)
+    return fp.getvalue(), nonzero
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calculate AA prevalence')
+    parser.add_argument(
+        '--backend', choices=BACKENDS, default='python',
+        help='aggregation backend (default: python)')
+    parser.add_argument(
+        '--jobs', type=int, default=1, metavar='N',
+        help='spread gene/category units over N processes (default: 1)')
+    parser.add_argument(
+        '--sparse', action='store_true',
+        help='also write non-zero cells to SGS.<gene>prevalence.npz')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='reuse the persisted aggregation state in local/prevalence '
+        'and only fold in newly appended sequences')
+    parser.add_argument(
+        '--compact', action='store_true',
+        help='load sequences as compact records to save memory')
+    args = parser.parse_args()
+    if args.incremental and (args.backend != 'python' or args.jobs > 1):
+        parser.error('--incremental requires the python backend '
+                     'and --jobs 1')
+    aggregate = BACKENDS[args.backend]
+    sequences = load_sequences(filtered=True, compact=args.compact)
+    if args.jobs > 1:
+        encode, _ = UNIT_BACKENDS[args.backend]
+        for gene in GENES:
+            _SHARED_GENES[gene] = encode(gene, sequences)
+        units = [(gene, cat, args.backend, args.sparse)
+                 for gene in GENES for cat in CATEGORIES]
+        with mp.get_context('fork').Pool(args.jobs) as pool:
+            results = pool.starmap(prevalence_csv, units, chunksize=1)
+        for gene in GENES:
+            sparse = OrderedDict()
+            with open(OUTPUTS[gene], 'w') as fp:
+                csv.DictWriter(fp, HEADER).writeheader()
+                for (unitgene, cat, *_), (chunk, nonzero) in \
+                        zip(units, results):
+                    if unitgene == gene:
+                        fp.write(chunk)
+                        sparse[cat] = nonzero
+            if args.sparse:
+                write_sparse_prevalence(SPARSE_PREVALENCE[gene], gene, sparse)
+        return
+    for gene in GENES:
+        if args.incremental:
+            agg = load_aggregation_state(gene, sequences)
+            save_aggregation_state(agg)
+            prevalences = agg.prevalences
+        else:
+            prevalences = aggregate(gene, sequences)
+        sparse = OrderedDict()
         with open(OUTPUTS[gene], 'w') as fp:
-            writer = csv.DictWriter(fp, header)
+            writer = csv.DictWriter(fp, HEADER)
             writer.writeheader()
-            writer.writerows(all_prevalence)
+            for cat, prev in prevalences.items():
+                rows = prev.rows()
+                if args.sparse:
+                    rows = list(rows)
+                    sparse[cat] = [row for row in rows if row['Count']]
+                writer.writerows(rows)
+        if args.sparse:
+            write_sparse_prevalence(SPARSE_PREVALENCE[gene], gene, sparse)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,21 @@
 import os
+import sys
 import csv
 import json
+import mmap
+import time
+import pickle
+import hashlib
 import requests
+import textwrap
+import threading
+import numpy as np
+from array import array
+from contextlib import contextmanager, suppress
 from decimal import Decimal
 from functools import cache  # require Python 3.9
-from collections import Counter
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 BASEDIR = os.path.dirname(
     os.path.dirname(os.path.abspath(__file__))
@@ -12,6 +23,21 @@ BASEDIR = os.path.dirname(
 
 FACTSHEET = os.path.join(BASEDIR, 'data', 'SGS.sequences.fact.csv')
 SIEERAREPORT = os.path.join(BASEDIR, 'local', 'SGS.sequences.json')
+SEQUENCES_FASTA = os.path.join(BASEDIR, 'local', 'SGS.sequences.fas')
+SIERRA_URL = 'https://hivdb.stanford.edu/graphql'
+SIERRA_QUERY = os.path.join(BASEDIR, 'scripts', 'query.gql')
+SIERRA_RESULTS_DIR = os.path.join(BASEDIR, 'local', 'sierra')
+SIERRA_CHUNK = 40
+SIERRA_WORKERS = 4
+SIERRA_RETRIES = 5
+SIERRA_BACKOFF = 5  # seconds, doubled after each failed attempt
+FASTA_INDEX_VERSION = 1
+SIERRA_CACHE = os.path.join(BASEDIR, 'local', 'SGS.sequences.cache.pickle')
+SIERRA_CACHE_VERSION = 1
+DATASET_CACHE = os.path.join(BASEDIR, 'local', 'SGS.dataset.cache.pickle')
+COMPACT_DATASET_CACHE = os.path.join(
+    BASEDIR, 'local', 'SGS.dataset.compact.cache.pickle')
+DATASET_CACHE_VERSION = 1
 DB_AA_VARIANTS_TABLE = (
     'https://raw.githubusercontent.com/hivdb/hivfacts/'
     'master/data/aapcnt/rx-all_subtype-all.json'
@@ -20,19 +46,154 @@ APOBEC_TABLE = (
     'https://raw.githubusercontent.com/hivdb/hivfacts/'
     'master/data/apobecs/apobecs.json'
 )
+HIVFACTS_TABLES = {
+    'aapcnt': DB_AA_VARIANTS_TABLE,
+    'apobecs': APOBEC_TABLE,
+}
+HIVFACTS_DIR = os.path.join(BASEDIR, 'local', 'hivfacts')
+HIVFACTS_TTL = 24 * 3600  # seconds before a snapshot is revalidated
+# NCBI allows 3 requests per second, or 10 with an API key
+NCBI_API_KEY = os.environ.get('NCBI_API_KEY')
+NCBI_RATE = 10 if NCBI_API_KEY else 3
+# never touch the network; snapshots must be fetched beforehand
+OFFLINE = os.environ.get('SGSDB_OFFLINE', '') not in ('', '0')
 AGG_MUTATIONS = {
     'PR': os.path.join(BASEDIR, 'data', 'prevalence', 'CompPR{}.csv'),
     'RT': os.path.join(BASEDIR, 'data', 'prevalence', 'CompRT{}.csv'),
     'IN': os.path.join(BASEDIR, 'data', 'prevalence', 'CompIN{}.csv'),
 }
+SPARSE_PREVALENCE = {
+    'PR': os.path.join(BASEDIR, 'data', 'prevalence', 'SGS.PRprevalence.npz'),
+    'RT': os.path.join(BASEDIR, 'data', 'prevalence', 'SGS.RTprevalence.npz'),
+    'IN': os.path.join(BASEDIR, 'data', 'prevalence', 'SGS.INprevalence.npz'),
+}
+SPARSE_NUMERIC_COLUMNS = (
+    'Pos', 'Pcnt', 'Count', 'PosTotal', 'PatientCount', 'PatientPosTotal',
+    'SampleCount', 'SamplePosTotal', 'IsAPOBEC'
+)
+SPARSE_TEXT_COLUMNS = (
+    'FromCodons', 'ToCodons', 'FromCodonsCtx', 'ToCodonsCtx'
+)
 PREC3 = Decimal('1.000')
 
+ALL_AAS = list('ACDEFGHIKLMNPQRSTVWY-_X*')
+AA_CODES = {aa: code for code, aa in enumerate(ALL_AAS)}
+NUM_AAS = len(ALL_AAS)
+# mixtures and unknown AAs are never annotated
+OTHER_AA = NUM_AAS
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Write ``path`` through ``path + '.tmp'``, replaced in one step
+
+    Readers see either the previous file or the complete new one. The
+    temporary file is removed when the block raises.
+    """
+    tmppath = path + '.tmp'
+    try:
+        with open(tmppath, mode) as fp:
+            yield fp
+        os.replace(tmppath, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmppath)
+        raise
+
+
+def _write_json_atomic(path, data):
+    with atomic_write(path) as fp:
+        json.dump(data, fp, indent=2)
+
+
+def load_hivfacts_meta(name):
+    metapath = os.path.join(HIVFACTS_DIR, '{}.meta.json'.format(name))
+    if not os.path.exists(metapath):
+        return {}
+    with open(metapath) as fp:
+        return json.load(fp)
+
+
+def load_hivfacts_table(name, refresh=False):
+    """Load a HIVfacts table through the local snapshot store
+
+    Snapshots are saved as HIVFACTS_DIR/<name>.<sha1>.json and tracked
+    in <name>.meta.json with the ETag/Last-Modified of the response.
+    A snapshot younger than HIVFACTS_TTL is used as is; an older one (or
+    any, when ``refresh`` is set) is revalidated with a conditional GET.
+    In OFFLINE mode, or when the remote is unreachable, the latest
+    snapshot is used without revalidation.
+    """
+    url = HIVFACTS_TABLES[name]
+    meta = load_hivfacts_meta(name)
+    if meta.get('url') != url:
+        meta = {'history': meta.get('history', [])}
+    snapshot = None
+    if meta.get('current'):
+        snapshot = os.path.join(HIVFACTS_DIR, meta['current'])
+        if not os.path.exists(snapshot):
+            snapshot = None
+
+    def read_snapshot():
+        with open(snapshot) as fp:
+            return json.load(fp)
+
+    if snapshot and (OFFLINE or (
+        not refresh and time.time() - meta['checked'] < HIVFACTS_TTL
+    )):
+        return read_snapshot()
+    if OFFLINE:
+        raise RuntimeError(
+            'No local snapshot of {} in offline mode; run `make hivfacts` '
+            'on a networked host and copy {}'.format(name, HIVFACTS_DIR))
+
+    headers = {}
+    if snapshot and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if snapshot and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        resp = requests.get(url, headers=headers, timeout=60)
+        resp.raise_for_status()
+    except requests.RequestException as exc:
+        if not snapshot:
+            raise
+        print('Warning: unable to revalidate {} ({}), using snapshot {}'
+              .format(name, exc, meta['current']), file=sys.stderr)
+        return read_snapshot()
+
+    os.makedirs(HIVFACTS_DIR, exist_ok=True)
+    meta['checked'] = time.time()
+    if resp.status_code == 304:
+        _write_json_atomic(
+            os.path.join(HIVFACTS_DIR, '{}.meta.json'.format(name)), meta)
+        return read_snapshot()
+
+    data = resp.json()
+    version = hashlib.sha1(resp.content).hexdigest()[:12]
+    filename = '{}.{}.json'.format(name, version)
+    if not os.path.exists(os.path.join(HIVFACTS_DIR, filename)):
+        with atomic_write(os.path.join(HIVFACTS_DIR, filename), 'wb') as fp:
+            fp.write(resp.content)
+    if meta.get('current') != filename:
+        meta['history'].append({'version': version,
+                                'fetched': meta['checked']})
+    meta.update({
+        'url': url,
+        'current': filename,
+        'version': version,
+        'etag': resp.headers.get('ETag'),
+        'last_modified': resp.headers.get('Last-Modified'),
+    })
+    _write_json_atomic(
+        os.path.join(HIVFACTS_DIR, '{}.meta.json'.format(name)), meta)
+    return data
+
 
 @cache
 def unusual_mutation_map():
     uum = set()
-    resp = requests.get(DB_AA_VARIANTS_TABLE)
-    data = resp.json()
+    data = load_hivfacts_table('aapcnt')
     for row in data:
         if not row['isUnusual']:
             continue
@@ -42,12 +203,98 @@ def unusual_mutation_map():
 
 @cache
 def apobec_mutation_map():
-    resp = requests.get(APOBEC_TABLE)
-    return {(r['gene'], r['position'], r['aa']) for r in resp.json()}
+    return {(r['gene'], r['position'], r['aa'])
+            for r in load_hivfacts_table('apobecs')}
+
+
+def compile_mutation_table(mutations):
+    """Compile a set of (gene, pos, aa) into dense lookup arrays
+
+    Returns {gene: bool array indexed by [position, aa_code]}, with an
+    extra always-False column for OTHER_AA.
+    """
+    sizes = Counter()
+    for gene, pos, _ in mutations:
+        sizes[gene] = max(sizes[gene], pos)
+    table = {gene: np.zeros((size + 1, NUM_AAS + 1), dtype=bool)
+             for gene, size in sizes.items()}
+    for gene, pos, aa in mutations:
+        if aa in AA_CODES and pos >= 0:
+            table[gene][pos, AA_CODES[aa]] = True
+    return table
+
+
+def encode_aas(aas):
+    return np.array([AA_CODES.get(aa, OTHER_AA) for aa in aas],
+                    dtype=np.uint8)
+
+
+def classify_mutations(table, gene, positions, aas):
+    """Vectorized ``(gene, pos, aa) in mutations`` of a compiled table
+
+    ``aas`` are AA strings, or codes from encode_aas().
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    codes = np.asarray(aas)
+    if codes.dtype.kind not in 'iu':
+        codes = encode_aas(aas)
+    result = np.zeros(len(positions), dtype=bool)
+    gtable = table.get(gene)
+    if gtable is not None and len(positions):
+        inrange = (positions >= 0) & (positions < len(gtable))
+        result[inrange] = gtable[positions[inrange], codes[inrange]]
+    return result
+
+
+def annotation_matrix(table, gene, genesize):
+    """Annotations of every [position, aa_code] cell of a gene"""
+    matrix = np.zeros((genesize + 1, NUM_AAS), dtype=bool)
+    gtable = table.get(gene)
+    if gtable is not None:
+        size = min(len(gtable), genesize + 1)
+        matrix[:size] = gtable[:size, :NUM_AAS]
+    return matrix
+
+
+@cache
+def unusual_mutation_table():
+    return compile_mutation_table(unusual_mutation_map())
+
+
+@cache
+def apobec_mutation_table():
+    return compile_mutation_table(apobec_mutation_map())
 
 
-def load_sequences(filtered=False):
-    sierra_reports = load_sierra_reports()
+def load_sequences(filtered=False, compact=False):
+    """Load included sequences joined with their Sierra reports
+
+    The joined dataset (with the _Filtered flag) is cached in
+    DATASET_CACHE, keyed on the SHA-1 of the fact sheet and of the Sierra
+    JSON, so later stages of the same input version skip the join.
+
+    With ``compact``, rows are CompactSequence records instead of dicts;
+    they support the same item access for the fields stages read.
+    """
+    sierra_key = sierra_report_key()
+    key = {
+        'version': DATASET_CACHE_VERSION,
+        'factsheet': file_digest(FACTSHEET),
+        'sierra': sierra_key['sha1'],
+    }
+    cache_path = COMPACT_DATASET_CACHE if compact else DATASET_CACHE
+    result = read_cache(cache_path, key)
+    if result is None:
+        result = join_sequences(load_sierra_reports(sierra_key))
+        if compact:
+            result = compact_sequences(result)
+        write_cache(cache_path, key, result)
+    if filtered:
+        result = [seq for seq in result if seq['_Filtered']]
+    return result
+
+
+def join_sequences(sierra_reports):
     with open(FACTSHEET) as fp:
         if fp.read(1) != '\ufeff':
             fp.seek(0)
@@ -62,35 +309,702 @@ def load_sequences(filtered=False):
         for seq in result:
             seq['_Filtered'] = \
                 counter[(seq['PtIdentifier'], seq['CollectionDate'])] >= 10
-        if filtered:
-            result = [seq for seq in result if seq['_Filtered']]
         return result
 
 
-def load_sierra_reports():
-    with open(SIEERAREPORT) as fp:
-        sequences = json.load(fp)
-        return {s['inputSequence']['header'].split('.', 1)[0]: s
-                for s in sequences}
+def popcount(bits):
+    """Number of ids in a bitset of interned ids"""
+    return bin(bits).count('1')
+
+
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def read_cache_key(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def read_cache(path, key):
+    """Load the payload of a pickle cache if its key matches"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as fp:
+        if pickle.load(fp) != key:
+            return None
+        return pickle.load(fp)
+
+
+def write_cache(path, key, payload):
+    """Write a pickle cache: the key first, then the payload"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write(path, 'wb') as fp:
+        pickle.dump(key, fp, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(payload, fp, pickle.HIGHEST_PROTOCOL)
+
+
+def trim_sierra_report(report):
+    """Keep only the Sierra fields read by the analysis stages"""
+    return {
+        'subtypeText': report['subtypeText'],
+        'alignedGeneSequences': [{
+            'gene': {'name': gseq['gene']['name']},
+            'firstAA': gseq['firstAA'],
+            'lastAA': gseq['lastAA'],
+            'mutations': [{
+                'position': mut['position'],
+                'AAs': mut['AAs'],
+                'isInsertion': mut['isInsertion'],
+                'isDeletion': mut['isDeletion'],
+            } for mut in gseq['mutations']],
+            'alignedNAs': gseq['alignedNAs'],
+        } for gseq in report['alignedGeneSequences']]
+    }
+
+
+def sierra_report_key():
+    """Cache key of the Sierra JSON: its size, mtime and SHA-1
+
+    The SHA-1 is only recomputed when the size or mtime differ from the
+    ones recorded in SIERRA_CACHE. When only the mtime changed and the
+    hash still matches, the key of SIERRA_CACHE is updated so the next
+    call skips the hash again.
+    """
+    stat = os.stat(SIEERAREPORT)
+    key = {
+        'version': SIERRA_CACHE_VERSION,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+    }
+    cached_key = read_cache_key(SIERRA_CACHE)
+    if cached_key and cached_key == dict(key, sha1=cached_key.get('sha1')):
+        key['sha1'] = cached_key['sha1']
+        return key
+    key['sha1'] = file_digest(SIEERAREPORT)
+    if cached_key and dict(cached_key, mtime=key['mtime']) == key:
+        write_cache(SIERRA_CACHE, key, read_cache(SIERRA_CACHE, cached_key))
+    return key
+
+
+def load_sierra_reports(key=None):
+    """Load Sierra reports keyed by accession
+
+    Reports are trimmed by trim_sierra_report() and cached in
+    SIERRA_CACHE, keyed on sierra_report_key() unless ``key`` is given.
+    """
+    if key is None:
+        key = sierra_report_key()
+    reports = read_cache(SIERRA_CACHE, key)
+    if reports is None:
+        with open(SIEERAREPORT) as fp:
+            sequences = json.load(fp)
+        reports = {s['inputSequence']['header'].split('.', 1)[0]:
+                   trim_sierra_report(s) for s in sequences}
+        write_cache(SIERRA_CACHE, key, reports)
+    return reports
+
+
+class Categories:
+    """Categorical codes of one field, shared by a dataset's records"""
+
+    __slots__ = ('values', 'codes')
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class CompactGene:
+    """Compact form of a trimmed Sierra gene sequence"""
+
+    __slots__ = ('name', 'first_aa', 'last_aa',
+                 'positions', 'aas', 'flags', 'aligned_nas')
+
+    def __init__(self, gseq):
+        self.name = sys.intern(gseq['gene']['name'])
+        self.first_aa = gseq['firstAA']
+        self.last_aa = gseq['lastAA']
+        muts = gseq['mutations']
+        self.positions = array('H', [m['position'] for m in muts])
+        self.aas = tuple(sys.intern(m['AAs']) for m in muts)
+        self.flags = bytes(m['isInsertion'] | m['isDeletion'] << 1
+                           for m in muts)
+        self.aligned_nas = gseq['alignedNAs']
+
+    def __getitem__(self, key):
+        if key == 'gene':
+            return {'name': self.name}
+        elif key == 'firstAA':
+            return self.first_aa
+        elif key == 'lastAA':
+            return self.last_aa
+        elif key == 'alignedNAs':
+            return self.aligned_nas
+        elif key == 'mutations':
+            return [{
+                'position': pos,
+                'AAs': aas,
+                'isInsertion': bool(flag & 1),
+                'isDeletion': bool(flag & 2),
+            } for pos, aas, flag in zip(self.positions, self.aas, self.flags)]
+        raise KeyError(key)
+
+    def to_dict(self):
+        return {key: self[key] for key in (
+            'gene', 'firstAA', 'lastAA', 'mutations', 'alignedNAs')}
+
+
+class CompactSequence:
+    """Compact sequence record with categorical codes
+
+    Supports ``record[field]`` for the fact sheet fields and the
+    ``_Sierra``/``_Filtered`` keys read by the analysis stages.
+    """
+
+    __slots__ = ('categories', 'accession', 'medline', 'date', 'source',
+                 'patient', 'rx', 'subtype', 'reservoir', 'filtered',
+                 'genes')
+
+    FIELDS = {
+        'MedlineID': 'medline',
+        'CollectionDate': 'date',
+        'Source': 'source',
+        'PtIdentifier': 'patient',
+        'Rx': 'rx',
+    }
+
+    def __init__(self, categories, seq):
+        self.categories = categories
+        self.accession = seq['Accession']
+        for field, slot in self.FIELDS.items():
+            setattr(self, slot, categories[slot].encode(seq[field]))
+        sierra = seq['_Sierra']
+        self.subtype = categories['subtype'].encode(
+            sierra['subtypeText'].split(' (', 1)[0])
+        self.reservoir = seq['_Reservoir'] == 'TRUE'
+        self.filtered = seq['_Filtered']
+        self.genes = tuple(CompactGene(gseq)
+                           for gseq in sierra['alignedGeneSequences'])
 
+    def __getitem__(self, key):
+        slot = self.FIELDS.get(key)
+        if slot:
+            return self.categories[slot].values[getattr(self, slot)]
+        elif key == 'Accession':
+            return self.accession
+        elif key == '_Filtered':
+            return self.filtered
+        elif key == '_Reservoir':
+            return 'TRUE' if self.reservoir else 'FALSE'
+        elif key == '_Sierra':
+            return {
+                'subtypeText':
+                self.categories['subtype'].values[self.subtype],
+                'alignedGeneSequences': self.genes,
+            }
+        raise KeyError(key)
 
-def load_aggregated_mutations(gene, subset='All'):
+
+def compact_sequences(sequences):
+    categories = {slot: Categories() for slot in (
+        *CompactSequence.FIELDS.values(), 'subtype')}
+    return [CompactSequence(categories, seq) for seq in sequences]
+
+
+AGG_INT_COLUMNS = ('Pos', 'Count', 'PosTotal', 'PatientCount',
+                   'PatientPosTotal', 'SampleCount', 'SamplePosTotal')
+AGG_FLOAT_COLUMNS = ('sgsPcnt', 'dbPcnt', 'pcntFold')
+AGG_BOOL_COLUMNS = ('IsAPOBEC', 'isUnusual')
+AGG_EXCLUDED_AAS = ('-', '_', '*', 'X')
+
+
+def load_aggregated_mutations(gene, subset='All', columnar=False):
+    """Load a Comp<gene><subset>.csv table
+
+    Returns a list of row dicts, or with ``columnar`` a dict of typed
+    NumPy column arrays (the same keys, including ``excluded``).
+    """
+    if columnar:
+        return load_aggregated_mutation_columns(gene, subset)
     with open(AGG_MUTATIONS[gene].format(subset)) as fp:
         result = []
         for row in csv.DictReader(fp):
             row['excluded'] = False
-            if row['AA'] in ('-', '_', '*', 'X'):
+            if row['AA'] in AGG_EXCLUDED_AAS:
                 row['excluded'] = True
             if row['dbPcnt'] == 'NA':
                 row['dbPcnt'] = .0
                 row['pcntFold'] = 0xffff
-            for k in ('Pos', 'Count', 'PosTotal',
-                      'PatientCount', 'PatientPosTotal',
-                      'SampleCount', 'SamplePosTotal'):
+            for k in AGG_INT_COLUMNS:
                 row[k] = int(row[k])
-            for k in ('sgsPcnt', 'dbPcnt', 'pcntFold'):
+            for k in AGG_FLOAT_COLUMNS:
                 row[k] = float(row[k])
-            for k in ('IsAPOBEC', 'isUnusual'):
+            for k in AGG_BOOL_COLUMNS:
                 row[k] = row[k].upper() == 'TRUE'
             result.append(row)
         return result
+
+
+def load_aggregated_mutation_columns(gene, subset='All'):
+    with open(AGG_MUTATIONS[gene].format(subset)) as fp:
+        reader = csv.reader(fp)
+        header = next(reader)
+        values = list(zip(*reader)) or [()] * len(header)
+        columns = {name: np.array(column, dtype=str)
+                   for name, column in zip(header, values)}
+    result = dict(columns)
+    result['excluded'] = np.isin(columns['AA'], AGG_EXCLUDED_AAS)
+    dbna = columns['dbPcnt'] == 'NA'
+    for k in AGG_INT_COLUMNS:
+        result[k] = columns[k].astype(np.int64)
+    for k in ('sgsPcnt', 'dbPcnt', 'pcntFold'):
+        values = columns[k].copy()
+        if k != 'sgsPcnt':
+            values[dbna] = '0'
+        result[k] = values.astype(np.float64)
+    result['pcntFold'][dbna] = 0xffff
+    for k in AGG_BOOL_COLUMNS:
+        result[k] = np.char.upper(columns[k]) == 'TRUE'
+    return result
+
+
+def load_sparse_prevalence(gene, category='All'):
+    """Load the non-zero prevalence cells of one gene/category slice
+
+    Returns a dict of typed column arrays (text columns as lists of
+    str), sorted by (Pos, AA). Use lookup_sparse_prevalence() to find a
+    single cell.
+    """
+    with np.load(SPARSE_PREVALENCE[gene]) as npz:
+        categories = npz['categories'].tolist()
+        if category not in categories:
+            raise KeyError('Category {!r} not found in {}'.format(
+                category, SPARSE_PREVALENCE[gene]))
+        catidx = categories.index(category)
+        start, stop = npz['offsets'][catidx:catidx + 2]
+        aas = npz['aas']
+        columns = {
+            'Gene': str(npz['gene']),
+            'Category': category,
+            'AA': aas[npz['AA'][start:stop]],
+            '_key': (npz['Pos'][start:stop].astype(np.int64) * len(aas) +
+                     npz['AA'][start:stop]),
+            '_aas': aas.tolist(),
+        }
+        for name in SPARSE_NUMERIC_COLUMNS:
+            columns[name] = npz[name][start:stop]
+        for name in SPARSE_TEXT_COLUMNS:
+            offsets = npz[name + '_offsets'][start:stop + 1]
+            data = npz[name + '_data'][offsets[0]:offsets[-1]].tobytes()
+            offsets = (offsets - offsets[0]).tolist()
+            columns[name] = [data[a:b].decode()
+                             for a, b in zip(offsets, offsets[1:])]
+        return columns
+
+
+def lookup_sparse_prevalence(columns, pos, aa):
+    """Return the row of (pos, aa) in a sparse slice, or None if zero"""
+    key = pos * len(columns['_aas']) + columns['_aas'].index(aa)
+    idx = np.searchsorted(columns['_key'], key)
+    if idx == len(columns['_key']) or columns['_key'][idx] != key:
+        return None
+    row = {'Gene': columns['Gene'], 'Category': columns['Category'],
+           'AA': aa}
+    for name in SPARSE_NUMERIC_COLUMNS:
+        row[name] = columns[name][idx].item()
+    for name in SPARSE_TEXT_COLUMNS:
+        row[name] = columns[name][idx]
+    return row
+
+
+FastaRecord = namedtuple(
+    'FastaRecord',
+    ['accession', 'offset', 'end', 'length', 'linebases', 'linewidth',
+     'header']
+)
+
+
+def scan_fasta(path):
+    """Yield a FastaRecord for each record of a FASTA file
+
+    ``offset`` and ``end`` delimit the sequence lines of the record.
+    Like a samtools .fai, ``linebases`` and ``linewidth`` are the bases
+    and bytes of every sequence line but the last one; both are 0 when
+    the lines are not evenly wrapped.
+    """
+    def finish(record):
+        if record['linebases'] is None:
+            record['linebases'] = record['linewidth'] = 0
+        return FastaRecord(**record)
+
+    record = None
+    offset = 0
+    with open(path, 'rb') as fp:
+        for line in fp:
+            lineoffset = offset
+            offset += len(line)
+            if line.startswith(b'>'):
+                if record:
+                    yield finish(record)
+                header = line[1:].strip().decode()
+                record = {
+                    'accession': header.split('.', 1)[0],
+                    'offset': offset, 'end': offset, 'length': 0,
+                    'linebases': None, 'linewidth': None,
+                    'header': header,
+                }
+                lastbases = None
+                continue
+            if record is None:
+                continue
+            bases = len(line.strip())
+            if line.startswith(b'#') or not bases:
+                # comments and blank lines are skipped, but only allowed
+                # after the last sequence line of an evenly wrapped record
+                if record['linebases'] is None:
+                    record['linebases'] = record['linewidth'] = 0
+                continue
+            if record['linebases'] is None:
+                record['linebases'] = bases
+                record['linewidth'] = len(line)
+            if record['linebases'] and (
+                lineoffset != record['end'] or
+                lastbases not in (None, record['linebases']) or
+                bases > record['linebases'] or
+                len(line.rstrip(b'\r\n')) != bases
+            ):
+                record['linebases'] = record['linewidth'] = 0
+            lastbases = bases
+            record['length'] += bases
+            record['end'] = offset
+    if record:
+        yield finish(record)
+
+
+def load_fasta_index(path):
+    """Load the index of a FASTA file, rebuilding it when stale
+
+    The index is saved next to the file as <path>.idx, a TSV of
+    FastaRecord fields headed by the size and mtime of the FASTA file.
+    """
+    stat = os.stat(path)
+    key = '#fasta-index\t{}\t{}\t{}\n'.format(
+        FASTA_INDEX_VERSION, stat.st_size, stat.st_mtime_ns)
+    indexpath = path + '.idx'
+    if os.path.exists(indexpath):
+        with open(indexpath) as fp:
+            if fp.readline() == key:
+                records = []
+                for line in fp:
+                    acc, *nums, header = line.rstrip('\n').split('\t', 6)
+                    records.append(FastaRecord(
+                        acc, *(int(n) for n in nums), header))
+                return records
+    records = list(scan_fasta(path))
+    with atomic_write(indexpath) as fp:
+        fp.write(key)
+        for record in records:
+            fp.write('\t'.join(str(v) for v in record))
+            fp.write('\n')
+    return records
+
+
+class FastaStore:
+    """Random access to the sequences of an indexed FASTA file
+
+    The file is memory-mapped; reading a sequence or a slice of it only
+    touches the bytes of that record.
+    """
+
+    def __init__(self, path=SEQUENCES_FASTA):
+        self.path = path
+        self.records = load_fasta_index(path)
+        self.index = {}
+        self.duplicates = []
+        for record in self.records:
+            if record.accession in self.index:
+                self.duplicates.append(record.accession)
+            else:
+                self.index[record.accession] = record
+        self._fp = open(path, 'rb')
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ) \
+            if self.records else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._fp.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, accession):
+        return accession in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, accession):
+        return self.get(accession)
+
+    def header(self, accession):
+        return self.index[accession].header
+
+    def _position(self, record, pos):
+        """Byte offset of the base at ``pos`` of a wrapped record"""
+        lineno, col = divmod(pos, record.linebases)
+        return record.offset + lineno * record.linewidth + col
+
+    def get(self, accession, start=0, stop=None):
+        """Return the bases ``[start:stop]`` of a sequence"""
+        record = self.index[accession]
+        start, stop, _ = slice(start, stop).indices(record.length)
+        if stop <= start:
+            return ''
+        if record.linebases:
+            chunk = self._mm[self._position(record, start):
+                             self._position(record, stop - 1) + 1]
+            return chunk.translate(None, b'\r\n').decode()
+        lines = self._mm[record.offset:record.end].splitlines()
+        seq = b''.join(line.strip() for line in lines
+                       if not line.startswith(b'#'))
+        return seq[start:stop].decode()
+
+
+class RateLimiter:
+    """Space out the starts of requests shared by several threads"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def is_transient_http_error(exc):
+    """Whether a failed HTTP request is worth retrying
+
+    Only 429 and 5xx answers are; errors without an HTTP status, such as
+    connection failures and timeouts, are too.
+    """
+    status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return not status or status >= 500 or status == 429
+
+
+def retry(func, retries, backoff, exceptions, what='request',
+          retryable=None):
+    """Call ``func()`` until it returns, with exponential backoff
+
+    Errors of ``exceptions`` (for which ``retryable(exc)`` holds, if
+    given) are retried up to ``retries`` attempts in total, waiting
+    ``backoff`` seconds doubled after each one, or longer when the server
+    answered with a Retry-After header.
+    """
+    for attempt in range(retries):
+        try:
+            return func()
+        except exceptions as exc:
+            if attempt + 1 == retries or (
+                retryable is not None and not retryable(exc)
+            ):
+                raise
+            delay = backoff * 2 ** attempt
+            headers = getattr(getattr(exc, 'response', None), 'headers', {})
+            retry_after = headers.get('Retry-After') if headers else None
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            print('Warning: {} failed ({}), retrying in {}s'
+                  .format(what, exc, delay), file=sys.stderr)
+            time.sleep(delay)
+
+
+def run_parallel(func, tasks, workers, on_result):
+    """Call ``func(task)`` for each task on a pool of ``workers`` threads
+
+    ``on_result(task, result)`` is called on this thread as each call
+    finishes, so finished work can be saved right away. On the first
+    error the tasks not started yet are cancelled, the running ones are
+    still collected, and then the error is raised.
+    """
+    executor = ThreadPoolExecutor(workers)
+    try:
+        futures = {executor.submit(func, task): task for task in tasks}
+        error = None
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as exc:
+                if error is None:
+                    error = exc
+                    for other in futures:
+                        other.cancel()
+                continue
+            on_result(futures[future], result)
+        if error is not None:
+            raise error
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def sequence_key(sequence):
+    """SHA-1 of a nucleotide sequence, ignoring case and whitespace"""
+    return hashlib.sha1(
+        ''.join(sequence.split()).upper().encode()).hexdigest()
+
+
+def sierra_context(client, query):
+    """Cache directory of the results of a query and Sierra version
+
+    The latest directory of each query is recorded in latest.json, so it
+    is reused in OFFLINE mode without asking Sierra for its version.
+    """
+    queryhash = hashlib.sha1(query.encode()).hexdigest()
+    latestpath = os.path.join(SIERRA_RESULTS_DIR, 'latest.json')
+    latest = {}
+    if os.path.exists(latestpath):
+        with open(latestpath) as fp:
+            latest = json.load(fp)
+    if OFFLINE:
+        if queryhash not in latest:
+            raise RuntimeError(
+                'No cached Sierra results of this query in offline mode')
+        return os.path.join(SIERRA_RESULTS_DIR, latest[queryhash])
+    version = client.current_version()
+    context = hashlib.sha1(
+        json.dumps([query, version], sort_keys=True).encode()
+    ).hexdigest()[:16]
+    if latest.get(queryhash) != context:
+        os.makedirs(SIERRA_RESULTS_DIR, exist_ok=True)
+        latest[queryhash] = context
+        _write_json_atomic(latestpath, latest)
+    return os.path.join(SIERRA_RESULTS_DIR, context)
+
+
+_SIERRA_CLIENTS = threading.local()
+
+
+def is_transport_error(exc):
+    """Whether a failed Sierra request is worth retrying
+
+    Connection failures, timeouts and 5xx/429 answers are; GraphQL errors
+    of the query itself would fail the same way again.
+    """
+    from gql.transport.exceptions import (
+        TransportProtocolError, TransportServerError)
+    if isinstance(exc, TransportServerError):
+        return exc.code is None or exc.code >= 500 or exc.code == 429
+    return isinstance(exc, (OSError, TransportProtocolError))
+
+
+def analyze_chunk(sequences, query):
+    """Analyze sequences in one Sierra request, retrying with backoff
+
+    Each thread has its own SierraClient.
+    """
+    import sierrapy  # slow to import, only needed by the Sierra stages
+    client = getattr(_SIERRA_CLIENTS, 'client', None)
+    if client is None:
+        client = _SIERRA_CLIENTS.client = sierrapy.SierraClient(SIERRA_URL)
+    results = retry(
+        lambda: client.sequence_analysis(
+            sequences, query, step=len(sequences)),
+        SIERRA_RETRIES, SIERRA_BACKOFF, Exception,
+        what='Sierra request', retryable=is_transport_error)
+    if len(results) != len(sequences):
+        raise RuntimeError('Sierra returned {} results for {} sequences'
+                           .format(len(results), len(sequences)))
+    return results
+
+
+def iter_sierra_results(sequences, query):
+    """Yield the Sierra result of each sequence, in order
+
+    ``sequences`` are dicts of header and sequence. Results are cached
+    by sequence_key() under the sierra_context() of the query, and only
+    the sequences missing from the cache are sent to Sierra, in chunks
+    of SIERRA_CHUNK with up to SIERRA_WORKERS chunks in flight.
+    """
+    import sierrapy
+    from tqdm import tqdm
+    client = sierrapy.SierraClient(SIERRA_URL)
+    context = sierra_context(client, query)
+    keys = [sequence_key(seq['sequence']) for seq in sequences]
+
+    def result_path(key):
+        return os.path.join(context, key[:2], key + '.json')
+
+    missing = {}
+    for seq, key in zip(sequences, keys):
+        if key not in missing and not os.path.exists(result_path(key)):
+            missing[key] = seq
+    if missing and OFFLINE:
+        raise RuntimeError(
+            '{} sequences have no cached Sierra result in offline mode'
+            .format(len(missing)))
+    if missing:
+        print('Analyzing {} of {} sequences not found in {}'
+              .format(len(missing), len(sequences), context),
+              file=sys.stderr)
+        missing = list(missing.items())
+        chunks = [missing[offset:offset + SIERRA_CHUNK]
+                  for offset in range(0, len(missing), SIERRA_CHUNK)]
+
+        def save(chunk, results):
+            # each finished chunk is saved right away, so a rerun after
+            # a crash resumes with the chunks left
+            for (key, _), result in zip(chunk, results):
+                os.makedirs(os.path.dirname(result_path(key)), exist_ok=True)
+                _write_json_atomic(result_path(key), result)
+            pbar.update(len(chunk))
+
+        with tqdm(total=len(missing)) as pbar:
+            run_parallel(
+                lambda chunk: analyze_chunk([seq for _, seq in chunk], query),
+                chunks, SIERRA_WORKERS, save)
+
+    for seq, key in zip(sequences, keys):
+        with open(result_path(key)) as fp:
+            result = json.load(fp)
+        if 'inputSequence' in result:
+            # identical sequences may come with different headers
+            result['inputSequence']['header'] = seq['header']
+        yield result
+
+
+def write_json_list(items, path):
+    """Write items as json.dump(list(items), indent=2) would, one by one"""
+    sep = '\n'
+    with atomic_write(path) as fp:
+        fp.write('[')
+        for item in items:
+            fp.write(sep)
+            fp.write(textwrap.indent(json.dumps(item, indent=2), '  '))
+            sep = ',\n'
+        fp.write(']' if sep == '\n' else '\n]')
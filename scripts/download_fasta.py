@@ -0,0 +1,179 @@
+#! /usr/bin/env python
+"""
+Download the GenBank sequences of the fact sheet to local/SGS.sequences.fas
+
+Please do not call this script directly, use `make fasta`
+"""
+import os
+import sys
+import csv
+import shutil
+import hashlib
+import argparse
+
+import requests
+
+from common import (BASEDIR, FACTSHEET, SEQUENCES_FASTA, NCBI_API_KEY,
+                    NCBI_RATE, FastaStore, RateLimiter, atomic_write,
+                    is_transient_http_error, retry, run_parallel)
+
+FASTA_URL = 'https://www.ncbi.nlm.nih.gov/sviewer/viewer.fcgi'
+FASTA_BATCHES_DIR = os.path.join(BASEDIR, 'local', 'fasta')
+FASTA_BATCH = 500
+FASTA_WORKERS = 3
+FASTA_RETRIES = 5
+FASTA_BACKOFF = 2  # seconds, doubled after each failed attempt
+FASTA_LINE_WIDTH = 70
+
+
+def read_accessions():
+    with open(FACTSHEET) as fp:
+        if fp.read(1) != '\ufeff':
+            fp.seek(0)
+        return list(dict.fromkeys(
+            row['Accession'] for row in csv.DictReader(fp)))
+
+
+def received_accessions():
+    """Accessions found in the downloaded batch files"""
+    received = set()
+    if not os.path.isdir(FASTA_BATCHES_DIR):
+        return received
+    for name in os.listdir(FASTA_BATCHES_DIR):
+        if name.endswith('.fas'):
+            with FastaStore(os.path.join(FASTA_BATCHES_DIR, name)) as store:
+                received.update(store)
+    return received
+
+
+def fetch_batch(session, limiter, accs):
+    """Download a batch of accessions as FASTA text, retrying with backoff"""
+    params = {
+        'db': 'nuccore',
+        'dopt': 'fasta',
+        'sendto': 'on',
+        'id': ','.join(accs)
+    }
+    if NCBI_API_KEY:
+        # NCBI_RATE only allows 10 requests per second with the key
+        params['api_key'] = NCBI_API_KEY
+
+    def fetch():
+        limiter.wait()
+        resp = session.get(FASTA_URL, params=params, timeout=300)
+        resp.raise_for_status()
+        if not resp.text.strip():
+            raise ValueError('empty FASTA response')
+        if not resp.text.startswith('>'):
+            raise ValueError('not a FASTA response')
+        return resp.text
+
+    return retry(fetch, FASTA_RETRIES, FASTA_BACKOFF,
+                 (requests.RequestException, ValueError),
+                 what='batch of {}'.format(accs[0]),
+                 retryable=is_transient_http_error)
+
+
+def save_batch(accs, text):
+    """Write a batch to its own file; it only counts once complete"""
+    name = hashlib.sha1(','.join(accs).encode()).hexdigest()[:16]
+    path = os.path.join(FASTA_BATCHES_DIR, name + '.fas')
+    with atomic_write(path) as fp:
+        fp.write(text)
+
+
+def download(accs, workers):
+    """Fetch the accessions in batches, several at a time"""
+    os.makedirs(FASTA_BATCHES_DIR, exist_ok=True)
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=workers))
+    limiter = RateLimiter(NCBI_RATE)
+    batches = [accs[offset:offset + FASTA_BATCH]
+               for offset in range(0, len(accs), FASTA_BATCH)]
+
+    def save(batch, text):
+        save_batch(batch, text)
+        print('.', end='', flush=True, file=sys.stderr)
+
+    try:
+        run_parallel(lambda batch: fetch_batch(session, limiter, batch),
+                     batches, workers, save)
+    finally:
+        print(file=sys.stderr)
+
+
+def assemble(accs):
+    """Write the accessions of all batches to SEQUENCES_FASTA, in order
+
+    Each accession is written once even when downloaded in several
+    batches; the ones never downloaded are left for verify() to report.
+    """
+    stores = [FastaStore(os.path.join(FASTA_BATCHES_DIR, name))
+              for name in sorted(os.listdir(FASTA_BATCHES_DIR))
+              if name.endswith('.fas')]
+    located = {}
+    for store in stores:
+        for acc in store:
+            located.setdefault(acc, store)
+    with atomic_write(SEQUENCES_FASTA) as fp:
+        for acc in accs:
+            store = located.get(acc)
+            if store is None:
+                continue
+            seq = store[acc]
+            fp.write('>{}\n'.format(store.header(acc)))
+            for offset in range(0, len(seq), FASTA_LINE_WIDTH):
+                fp.write(seq[offset:offset + FASTA_LINE_WIDTH])
+                fp.write('\n')
+    for store in stores:
+        store.close()
+
+
+def verify(accs):
+    """Check that every accession is in SEQUENCES_FASTA exactly once"""
+    with FastaStore(SEQUENCES_FASTA) as store:
+        found = [record.accession for record in store.records]
+    errors = []
+    if store.duplicates:
+        errors.append('duplicated: {}'.format(
+            ', '.join(sorted(set(store.duplicates)))))
+    absent = set(accs) - set(found)
+    if absent:
+        errors.append('missing: {}'.format(', '.join(sorted(absent))))
+    unexpected = set(found) - set(accs)
+    if unexpected:
+        errors.append('not in the fact sheet: {}'.format(
+            ', '.join(sorted(unexpected))))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '--restart', action='store_true',
+        help='discard the batches downloaded by previous runs')
+    parser.add_argument(
+        '--jobs', type=int, default=FASTA_WORKERS,
+        help='number of batches downloaded at the same time')
+    args = parser.parse_args()
+    if args.restart:
+        shutil.rmtree(FASTA_BATCHES_DIR, ignore_errors=True)
+
+    accs = read_accessions()
+    received = received_accessions()
+    pending = [acc for acc in accs if acc not in received]
+    print('{} of {} accessions to download'.format(len(pending), len(accs)),
+          file=sys.stderr)
+    if pending:
+        download(pending, args.jobs)
+    assemble(accs)
+    errors = verify(accs)
+    for error in errors:
+        print('Error: {}'.format(error), file=sys.stderr)
+    if errors:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,17 @@
 #! /usr/bin/env python
 import os
 import csv
+import argparse
 
 from decimal import Decimal
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, namedtuple
 
 from numpy import percentile
 from scipy.stats import linregress, chi2_contingency
 
 from common import (load_sequences, load_aggregated_mutations,
-                    apobec_mutation_map, BASEDIR, PREC3)
+                    apobec_mutation_table, classify_mutations, popcount,
+                    BASEDIR, PREC3)
 
 REPORT_PATH = os.path.join(BASEDIR, 'data', 'report.csv')
 GENES = ('PR', 'RT', 'IN')
@@ -28,7 +30,7 @@ GENE_RANGES = {
     ],
 }
 SUBTYPES = ('B', 'C', 'Other')
-APM = apobec_mutation_map()
+APOBECS = apobec_mutation_table()
 
 header = ['name', 'subset', 'value', 'percent',
           'range_0', 'range_100', 'r_squared',
@@ -90,33 +92,33 @@ def get_subtype(seq):
 
 
 def prevalence_stat(gene, cat, splcount):
-    mutations = load_aggregated_mutations(gene, cat)
-    splmuttotal = sum(m['SampleCount'] for m in mutations
-                      if not m['excluded'])
+    muts = load_aggregated_mutations(gene, cat, columnar=True)
+    included = ~muts['excluded']
+    unusual = muts['isUnusual'] & included
+    apobec = muts['IsAPOBEC']
+    seqeq1 = muts['Count'] == 1
+    seqgt1 = muts['Count'] > 1
+    splcounts = muts['SampleCount']
+
+    splmuttotal = int(splcounts[included].sum())
     yield make_row(
         '# Mutations per Sample',
         'Gene={}, Category={}'.format(gene, cat),
         splmuttotal / splcount)
-    spluumtotal = sum(m['SampleCount'] for m in mutations if
-                      m['isUnusual'] and not m['excluded'])
+    spluumtotal = int(splcounts[unusual].sum())
     yield make_row(
         '# Mutations per Sample',
         'Gene={}, Category={}, '
         'IsUnusual'.format(gene, cat),
         spluumtotal / splcount, total=splmuttotal / splcount)
-    splmutgt1total = sum(m['SampleCount'] for m in mutations
-                         if m['Count'] > 1 and not m['excluded'])
+    splmutgt1total = int(splcounts[seqgt1 & included].sum())
     yield make_row(
         '# Mutations per Sample',
         'Gene={}, Category={}, NumSequences>1'.format(gene, cat),
         splmutgt1total / splcount, total=splmuttotal / splcount)
 
-    spluumeq1total = sum(
-        m['SampleCount'] for m in mutations if m['Count'] == 1
-        and m['isUnusual'] and not m['excluded'])
-    spluumgt1total = sum(
-        m['SampleCount'] for m in mutations if m['Count'] > 1
-        and m['isUnusual'] and not m['excluded'])
+    spluumeq1total = int(splcounts[seqeq1 & unusual].sum())
+    spluumgt1total = int(splcounts[seqgt1 & unusual].sum())
     yield make_row(
         '# Mutations',
         'Gene={}, Category={}, NumSequences=1, '
@@ -146,9 +148,8 @@ def prevalence_stat(gene, cat, splcount):
         'IsUnusual'.format(gene, cat),
         spluumgt1total / splcount,
         total=splmuttotal / splcount)
-    # splpttotal = sum(m['SampleCount'] for m in mutations
-    #                  if m['PatientCount'] > 1
-    #                  and not m['excluded']) / splcount
+    # ptgt1 = muts['PatientCount'] > 1
+    # splpttotal = int(splcounts[ptgt1 & included].sum()) / splcount
     # yield make_row(
     #     '# Mutations per Sample',
     #     'Gene={}, Category={}, NumPatients>1'.format(gene, cat),
@@ -157,24 +158,20 @@ def prevalence_stat(gene, cat, splcount):
     #     '# Mutations per Sample',
     #     'Gene={}, Category={}, NumPatients>1, '
     #     'IsUnusual'.format(gene, cat),
-    #     sum(m['SampleCount'] for m in mutations if m['PatientCount'] > 1
-    #         and m['isUnusual'] and
-    #         not m['excluded']) / splcount,
+    #     int(splcounts[ptgt1 & unusual].sum()) / splcount,
     #     total=splpttotal)
     # yield make_row(
     #     '# Mutations per Sample',
     #     'Gene={}, Category={}, NumSequences>1, '
     #     'IsAPOBEC'.format(gene, cat),
-    #     sum(m['SampleCount'] for m in mutations if m['Count'] > 1
-    #         and m['IsAPOBEC']) / splcount)
+    #     int(splcounts[seqgt1 & apobec].sum()) / splcount)
     # yield make_row(
     #     '# Mutations per Sample',
     #     'Gene={}, Category={}, NumPatients>1, '
     #     'IsAPOBEC'.format(gene, cat),
-    #     sum(m['SampleCount'] for m in mutations if m['PatientCount'] > 1
-    #         and m['IsAPOBEC']) / splcount)
+    #     int(splcounts[ptgt1 & apobec].sum()) / splcount)
 
-    muttotal = len([m for m in mutations if not m['excluded']])
+    muttotal = int(included.sum())
     yield make_row(
         '# Uniq. Mutations',
         'Gene={}, Category={}'.format(gene, cat),
@@ -183,16 +180,14 @@ def prevalence_stat(gene, cat, splcount):
         '# Uniq. Mutations',
         'Gene={}, Category={}, '
         'IsUnusual'.format(gene, cat),
-        len([m for m in mutations if
-             m['isUnusual'] and not m['excluded']]),
+        int(unusual.sum()),
         total=muttotal)
     yield make_row(
         '# Uniq. Mutations',
         'Gene={}, Category={}, '
         'IsAPOBEC'.format(gene, cat),
-        len([m for m in mutations if m['IsAPOBEC']]))
-    seqtotal = len([m for m in mutations
-                    if m['Count'] > 1 and not m['excluded']])
+        int(apobec.sum()))
+    seqtotal = int((seqgt1 & included).sum())
     yield make_row(
         '# Uniq. Mutations',
         'Gene={}, Category={}, NumSequences>1'.format(gene, cat),
@@ -201,16 +196,14 @@ def prevalence_stat(gene, cat, splcount):
         '# Uniq. Mutations',
         'Gene={}, Category={}, NumSequences>1, '
         'IsUnusual'.format(gene, cat),
-        len([m for m in mutations if m['Count'] > 1
-            and m['isUnusual'] and not m['excluded']]),
+        int((seqgt1 & unusual).sum()),
         total=seqtotal)
     yield make_row(
         '# Uniq. Mutations',
         'Gene={}, Category={}, NumSequences>1, '
         'IsAPOBEC'.format(gene, cat),
-        len([m for m in mutations if m['Count'] > 1 and m['IsAPOBEC']]))
-    # pttotal = len([m for m in mutations
-    #                if m['PatientCount'] > 1 and not m['excluded']])
+        int((seqgt1 & apobec).sum()))
+    # pttotal = int((ptgt1 & included).sum())
     # yield make_row(
     #     '# Uniq. Mutations',
     #     'Gene={}, Category={}, NumPatients>1'.format(gene, cat),
@@ -219,19 +212,17 @@ def prevalence_stat(gene, cat, splcount):
     #     '# Uniq. Mutations',
     #     'Gene={}, Category={}, NumPatients>1, '
     #     'IsUnusual'.format(gene, cat),
-    #     len([m for m in mutations if m['PatientCount'] > 1
-    #          and m['isUnusual'] and not m['excluded']]),
+    #     int((ptgt1 & unusual).sum()),
     #     total=pttotal)
     # yield make_row(
     #     '# Uniq. Mutations',
     #     'Gene={}, Category={}, NumPatients>1, '
     #     'IsAPOBEC'.format(gene, cat),
-    #     len([m for m in mutations if
-    #          m['PatientCount'] > 1 and m['IsAPOBEC']]))
+    #     int((ptgt1 & apobec).sum()))
     yield make_linregress_row(
         'Prevalence Correlation b/t SGS and HIVDB',
         'Gene={}, Category={}'.format(gene, cat),
-        [(m['sgsPcnt'], m['dbPcnt']) for m in mutations if not m['excluded']])
+        muts['sgsPcnt'][included], muts['dbPcnt'][included])
 
 
 # def overall_prevalence_stat():
@@ -251,164 +242,246 @@ def prevalence_stat(gene, cat, splcount):
 #         pttotal2, total=muttotal)
 
 
-def basic_stat(sequences, outcond=''):
-    pmids = set()
-    ptids = set()
-    pttps = defaultdict(set)
-    geneseqs = Counter()
-    generangeseqs = Counter()
-    geneptids = defaultdict(set)
-    genepttps = defaultdict(set)
-    subtypepttps = defaultdict(set)
-    rxptids = defaultdict(set)
-    rxpttps = defaultdict(set)
-    subtypeseqs = Counter()
-    apobecseqs = Counter()
-    subtypeptids = defaultdict(set)
-    pttpseqs = Counter()
-    outcond0 = outcond.strip(' ,')
-    for seq in sequences:
-        pmids.add(seq['MedlineID'])
+SeqKey = namedtuple(
+    'SeqKey', ['filtered', 'subtype', 'rx', 'source', 'reservoir'])
+GeneKey = namedtuple('GeneKey', [*SeqKey._fields, 'gene', 'apobecs', 'ranges'])
+
+
+class CubeCell:
+    __slots__ = ('seqs', 'pts', 'spls', 'pmids')
+
+    def __init__(self):
+        self.seqs = 0
+        # distinct patients and samples are bitsets of interned ids
+        self.pts = 0
+        self.spls = 0
+        self.pmids = set()
+
+    def add(self, ptbit, splbit, pmid):
+        self.seqs += 1
+        self.pts |= ptbit
+        self.spls |= splbit
+        self.pmids.add(pmid)
+
+
+class ReportCube:
+    """Sequence, patient and sample counts grouped by every dimension
+
+    Built in one pass over all sequences; basic_stat() derives each row
+    by rolling up the cells that match its subset, so a new dimension
+    does not require another pass.
+    """
+
+    def __init__(self, sequences):
+        self.seqcells = defaultdict(CubeCell)
+        self.genecells = defaultdict(CubeCell)
+        # (filtered, label) => (seq index, order in seq) of first match
+        self.rangefirsts = {}
+        self.ptids = {}
+        self.samples = {}
+        for seqidx, seq in enumerate(sequences):
+            self.add(seqidx, seq)
+
+    def add(self, seqidx, seq):
         sierra = seq['_Sierra']
         ptid = seq['PtIdentifier']
         pttp = (ptid, seq['CollectionDate'])
-        ptids.add(ptid)
-        rx = seq['Rx']
-        rxptids[rx].add(ptid)
-        rxpttps[rx].add(pttp)
-        pttps[ptid].add(pttp)
-        pttpseqs[pttp] += 1
-        subtype = get_subtype(sierra)
-        subtypeseqs[subtype] += 1
-        subtypeptids[subtype].add(ptid)
-        subtypepttps[subtype].add(pttp)
+        filtered = seq['_Filtered']
+        ptidx = self.ptids.setdefault(ptid, len(self.ptids))
+        splidx, _, _, numseqs = self.samples.setdefault(
+            pttp, [len(self.samples), ptidx, filtered, 0])
+        self.samples[pttp][3] = numseqs + 1
+        ptbit = 1 << ptidx
+        splbit = 1 << splidx
+        pmid = seq['MedlineID']
+        seqkey = SeqKey(filtered, get_subtype(sierra), seq['Rx'],
+                        seq['Source'], seq['_Reservoir'])
+        self.seqcells[seqkey].add(ptbit, splbit, pmid)
+        order = 0
         for geneseq in sierra['alignedGeneSequences']:
             gene = geneseq['gene']['name']
-            geneseqs[gene] += 1
-            geneptids[gene].add(ptid)
-            subtypeptids[(subtype, gene)].add(ptid)
-            rxptids[(rx, gene)].add(ptid)
-            genepttps[gene].add(pttp)
+            ranges = []
             for (subset, func) in GENE_RANGES[gene]:
                 if func(geneseq['firstAA'], geneseq['lastAA']):
-                    generangeseqs['Gene={}, {}'.format(gene, subset)] += 1
-            numapobecs = 0
-            for mut in geneseq['mutations']:
-                pos = mut['position']
-                if gene == 'RT' and pos > 240:
-                    continue
-                aa = mut['AAs']
-                if (gene, pos, aa) in APM:
-                    numapobecs += 1
+                    label = 'Gene={}, {}'.format(gene, subset)
+                    ranges.append(label)
+                    self.rangefirsts.setdefault(
+                        (filtered, label), (seqidx, order))
+                    order += 1
+            muts = [(mut['position'], mut['AAs'])
+                    for mut in geneseq['mutations']
+                    if gene != 'RT' or mut['position'] <= 240]
+            numapobecs = int(classify_mutations(
+                APOBECS, gene,
+                [pos for pos, _ in muts], [aa for _, aa in muts]).sum())
             numapobecs = min(3, numapobecs)
-            if numapobecs > 0:
-                apobecseqs[(gene, numapobecs)] += 1
+            genekey = GeneKey(*seqkey, gene, numapobecs, tuple(ranges))
+            self.genecells[genekey].add(ptbit, splbit, pmid)
+
+    def rollup(self, cells, filtered=None, **criteria):
+        """Merge the cells matching every criterion
+
+        ``filtered=None`` merges both filter states; a ``ranges``
+        criterion matches cells whose ranges include it.
+        """
+        result = CubeCell()
+        for key, cell in cells.items():
+            if filtered is not None and key.filtered != filtered:
+                continue
+            if any(value not in key.ranges if name == 'ranges'
+                   else getattr(key, name) != value
+                   for name, value in criteria.items()):
+                continue
+            result.seqs += cell.seqs
+            result.pts |= cell.pts
+            result.spls |= cell.spls
+            result.pmids |= cell.pmids
+        return result
+
+    def sequences(self, filtered=None, **criteria):
+        return self.rollup(self.seqcells, filtered, **criteria)
+
+    def genes(self, filtered=None, **criteria):
+        return self.rollup(self.genecells, filtered, **criteria)
+
+    def gene_ranges(self, filtered=None):
+        firsts = {}
+        for (flag, label), first in self.rangefirsts.items():
+            if filtered is None or flag == filtered:
+                firsts[label] = min(first, firsts.get(label, first))
+        return sorted(firsts, key=firsts.get)
+
+    def samples_per_patient(self, filtered=None):
+        result = Counter()
+        for _, ptidx, flag, _ in self.samples.values():
+            if filtered is None or flag == filtered:
+                result[ptidx] += 1
+        return list(result.values())
+
+    def sequences_per_sample(self, filtered=None):
+        return [numseqs for _, _, flag, numseqs in self.samples.values()
+                if filtered is None or flag == filtered]
+
+
+def basic_stat(cube, filtered=None, outcond=''):
+    outcond0 = outcond.strip(' ,')
+    allseqs = cube.sequences(filtered)
 
-    yield make_row('# Studies', outcond0, len(pmids))
+    yield make_row('# Studies', outcond0, len(allseqs.pmids))
 
-    totalseqs = len(sequences)
+    totalseqs = allseqs.seqs
     yield make_row('# Sequences', outcond0, totalseqs)
     for gene in GENES:
         yield make_row('# Sequences',
                        outcond + 'Gene={}'.format(gene),
-                       geneseqs[gene],
+                       cube.genes(filtered, gene=gene).seqs,
                        total=totalseqs)
         addcond = ', MinPos=1, MaxPos=240' if gene == 'RT' else ''
         yield make_row('# Sequences',
                        outcond + 'Gene={}{}, NumAPOBECs=1'
                        .format(gene, addcond),
-                       apobecseqs[(gene, 1)],
+                       cube.genes(filtered, gene=gene, apobecs=1).seqs,
                        total=totalseqs)
         yield make_row('# Sequences',
                        outcond + 'Gene={}{}, NumAPOBECs=2'
                        .format(gene, addcond),
-                       apobecseqs[(gene, 2)],
+                       cube.genes(filtered, gene=gene, apobecs=2).seqs,
                        total=totalseqs)
         yield make_row('# Sequences',
                        outcond + 'Gene={}{}, NumAPOBECs>=3'
                        .format(gene, addcond),
-                       apobecseqs[(gene, 3)],
+                       cube.genes(filtered, gene=gene, apobecs=3).seqs,
                        total=totalseqs)
 
-    for subset, value in generangeseqs.items():
-        yield make_row('# Sequences', outcond + subset, value, total=totalseqs)
+    for subset in cube.gene_ranges(filtered):
+        yield make_row('# Sequences', outcond + subset,
+                       cube.genes(filtered, ranges=subset).seqs,
+                       total=totalseqs)
 
     for subtype in SUBTYPES:
         yield make_row('# Sequences',
                        outcond + 'Subtype={}'.format(subtype),
-                       subtypeseqs[subtype],
+                       cube.sequences(filtered, subtype=subtype).seqs,
                        total=totalseqs)
 
-    totalpts = len(ptids)
+    totalpts = popcount(allseqs.pts)
     yield make_row('# Patients', outcond0, totalpts)
     for gene in GENES:
         yield make_row('# Patients',
                        outcond + 'Gene={}'.format(gene),
-                       len(geneptids[gene]),
+                       popcount(cube.genes(filtered, gene=gene).pts),
                        total=totalpts)
     for subtype in SUBTYPES:
         yield make_row('# Patients',
                        outcond + 'Subtype={}'.format(subtype),
-                       len(subtypeptids[subtype]),
+                       popcount(cube.sequences(filtered, subtype=subtype).pts),
                        total=totalpts)
         for gene in GENES:
             yield make_row('# Patients',
                            outcond + 'Subtype={}, Gene={}'
                            .format(subtype, gene),
-                           len(subtypeptids[(subtype, gene)]),
+                           popcount(cube.genes(
+                               filtered, subtype=subtype, gene=gene).pts),
                            total=totalpts)
     for rx in TREATMENTS:
         yield make_row('# Patients',
                        outcond + 'Rx={}'.format(rx),
-                       len(rxptids[rx]),
+                       popcount(cube.sequences(filtered, rx=rx).pts),
                        total=totalpts)
         for gene in GENES:
             yield make_row('# Patients',
                            outcond + 'Rx={}, Gene={}'.format(rx, gene),
-                           len(rxptids[(rx, gene)]),
+                           popcount(cube.genes(
+                               filtered, rx=rx, gene=gene).pts),
                            total=totalpts)
+    numsamples = cube.samples_per_patient(filtered)
     yield make_row('# Patients', outcond + 'NumSample=1',
-                   len([k for k, v in pttps.items() if len(v) == 1]),
+                   len([n for n in numsamples if n == 1]),
                    total=totalpts)
     yield make_row('# Patients', outcond + 'NumSample>1',
-                   len([k for k, v in pttps.items() if len(v) > 1]),
+                   len([n for n in numsamples if n > 1]),
                    total=totalpts)
 
-    totalpttps = sum(len(v) for v in pttps.values())
+    totalpttps = popcount(allseqs.spls)
     yield make_row('# Samples (Patient Time Points)', outcond0, totalpttps)
     for gene in GENES:
         yield make_row('# Samples (Patient Time Points)',
                        outcond + 'Gene={}'.format(gene),
-                       len(genepttps[gene]),
+                       popcount(cube.genes(filtered, gene=gene).spls),
                        total=totalpttps)
     for subtype in SUBTYPES:
         yield make_row('# Samples (Patient Time Points)',
                        outcond + 'Subtype={}'.format(subtype),
-                       len(subtypepttps[subtype]),
+                       popcount(cube.sequences(
+                           filtered, subtype=subtype).spls),
                        total=totalpttps)
     for rx in TREATMENTS:
         yield make_row('# Samples (Patient Time Points)',
                        outcond + 'Rx={}'.format(rx),
-                       len(rxpttps[rx]),
+                       popcount(cube.sequences(filtered, rx=rx).spls),
                        total=totalpttps)
 
     yield make_percentile_row("Med. Samples per Patient",
-                              outcond0, [len(v) for v in pttps.values()])
+                              outcond0, numsamples)
     yield make_percentile_row("Med. Sequences per Sample",
-                              outcond0, pttpseqs.values())
+                              outcond0, cube.sequences_per_sample(filtered))
 
 
 def main():
-    sequences = load_sequences()
-    filtered_sequences = [s for s in sequences if s['_Filtered']]
+    parser = argparse.ArgumentParser(description='Make SGS report')
+    parser.add_argument(
+        '--compact', action='store_true',
+        help='load sequences as compact records to save memory')
+    args = parser.parse_args()
+    cube = ReportCube(load_sequences(compact=args.compact))
     with open(REPORT_PATH, 'w') as fp:
         writer = csv.DictWriter(fp, header)
         writer.writeheader()
         splcount = {}
-        for row in basic_stat(sequences):
+        for row in basic_stat(cube):
             writer.writerow(row)
 
-        for row in basic_stat(filtered_sequences, 'SequencesPerSample>9, '):
+        for row in basic_stat(cube, True, 'SequencesPerSample>9, '):
             writer.writerow(row)
             if row['name'] == '# Samples (Patient Time Points)':
                 if row['subset'].endswith('Gene=PR'):
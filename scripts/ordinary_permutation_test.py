@@ -7,7 +7,8 @@ import json
 import random
 from hivdbql import app
 
-from common import unusual_mutation_map, apobec_mutation_map
+from common import (unusual_mutation_table, apobec_mutation_table,
+                    classify_mutations)
 
 db = app.db
 models = app.models
@@ -18,8 +19,8 @@ BASEDIR = os.path.dirname(
 PROFILE_PATH = os.path.join(BASEDIR, 'local', 'permutation_profile.json')
 MUTPATTERN = re.compile(r'^([A-Z])(\d+)([A-Z_*-]+)')
 
-UUM = unusual_mutation_map()
-APM = apobec_mutation_map()
+UUM = unusual_mutation_table()
+APM = apobec_mutation_table()
 
 SUBTYPE_CATEGORIES = {
     'SubtypeB': models.Isolate._subtype.has(
@@ -133,19 +134,13 @@ def get_single_isolates(patients, gene):
 
 
 def count_unusual_mutations(gene, muts):
-    uum = 0
-    for pos, aa in muts:
-        if (gene, pos, aa) in UUM:
-            uum += 1
-    return uum
+    return int(classify_mutations(
+        UUM, gene, [pos for pos, _ in muts], [aa for _, aa in muts]).sum())
 
 
 def count_apobec_mutations(gene, muts):
-    apm = 0
-    for pos, aa in muts:
-        if (gene, pos, aa) in APM:
-            apm += 1
-    return apm
+    return int(classify_mutations(
+        APM, gene, [pos for pos, _ in muts], [aa for _, aa in muts]).sum())
 
 
 def parse_mutations(muts):
@@ -0,0 +1,25 @@
+#! /usr/bin/env python
+"""
+Refresh local snapshots of the HIVfacts tables
+
+Please do not call this script directly, use `make hivfacts`
+"""
+import sys
+
+from common import HIVFACTS_TABLES, load_hivfacts_meta, load_hivfacts_table
+
+
+def main():
+    for name in HIVFACTS_TABLES:
+        before = load_hivfacts_meta(name).get('version')
+        load_hivfacts_table(name, refresh=True)
+        after = load_hivfacts_meta(name).get('version')
+        if before == after:
+            print('{}: {} (unchanged)'.format(name, after), file=sys.stderr)
+        else:
+            print('{}: {} -> {}'.format(name, before, after),
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+#! /usr/bin/env python
+"""
+Analyze the downloaded sequences with Sierra, reusing cached results
+
+Please do not call this script directly, use `make sierra`
+"""
+from common import (SEQUENCES_FASTA, SIEERAREPORT, SIERRA_QUERY,
+                    FastaStore, iter_sierra_results, write_json_list)
+
+
+def main():
+    with open(SIERRA_QUERY) as fp:
+        query = fp.read()
+    with FastaStore(SEQUENCES_FASTA) as store:
+        sequences = [{'header': record.header,
+                      'sequence': store.get(record.accession)}
+                     for record in store.records]
+    write_json_list(iter_sierra_results(sequences, query), SIEERAREPORT)
+
+
+if __name__ == '__main__':
+    main()